@@ -0,0 +1,181 @@
+import multiprocessing
+import threading
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+from prg import chunk_ranges
+from storage import flat_tensor
+from shard import ADD, AGGREGATE, RESET, STOP, UNMASK, shard_worker
+
+
+# 流式聚合器：每收到一个客户端（或一层）的更新就立即累加进扁平的和向量，调用方随即释放该更新
+# 服务器内存只有一个模型大小的累加器，与客户端数量无关；最后一个更新到达时聚合结果即已就绪
+class StreamingAggregator(object):
+    def __init__(self, layout, state_dict, fixed_point=None, expected=0, mmap_dir=""):
+        self.layout = layout
+        # 不为空时累加器放在该目录下的内存映射文件中
+        self.mmap_dir = mmap_dir
+        self.fixed_point = fixed_point
+        self.expected = expected
+        # 不在扁平布局中的整数缓冲区（如num_batches_tracked）和低比特量化时不量化的浮点缓冲区单独累加
+        plain_names = set() if fixed_point is None else fixed_point.plain_names
+        self.others = {}
+        for name, params in state_dict.items():
+            if name not in layout.names or name in plain_names:
+                self.others[name] = torch.zeros_like(params)
+        self.allocate()
+        # 已经上传完成的客户端数量
+        self.count = 0
+        # 第几轮，reset后加1，用于等待本轮聚合完成
+        self.round = 0
+        self.cond = threading.Condition()
+
+    # 扁平累加器，ring模式下在int64上做回绕加法
+    def allocate(self):
+        dtype = torch.float32 if self.fixed_point is None else torch.int64
+        self.flat = flat_tensor(self.layout.numel, dtype, self.layout.device, self.mmap_dir, "accumulator")
+        # 扁平向量中各层的视图
+        self.layers = self.layout.unflatten(self.flat, {})
+
+    # 把一个客户端的完整更新字典累加进来，weight为该更新的权重（如异步模式下的陈旧度权重）
+    def add(self, diff, weight=1):
+        with self.cond:
+            for name in diff:
+                params = diff[name]
+                if weight != 1 and params.is_floating_point():
+                    params = params * weight
+                self._add_layer(name, params)
+            self._finish_client()
+
+    # 逐层接收时，每到一层就累加一层
+    def add_layer(self, name, params):
+        with self.cond:
+            self._add_layer(name, params)
+
+    def _add_layer(self, name, params):
+        if name in self.others:
+            data = self.others[name]
+            data.add_(params.to(data.device))
+        else:
+            self._add_flat(name, params)
+
+    def _add_flat(self, name, params):
+        data = self.layers[name]
+        data.add_(params.reshape(data.shape).to(data.device))
+        if self.fixed_point is not None:
+            self.fixed_point.wrap_(data)
+
+    # 一个客户端的所有层都已到达，返回当前轮次
+    def finish_client(self):
+        with self.cond:
+            self._finish_client()
+            return self.round
+
+    def _finish_client(self):
+        self.count += 1
+        if self.count >= self.expected:
+            self.cond.notify_all()
+
+    # 阻塞直到本轮所有客户端都上传完成
+    def wait(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.count >= self.expected, timeout)
+
+    # 阻塞直到第round_id轮的聚合完成（reset被调用）
+    def wait_round(self, round_id, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.round != round_id, timeout)
+
+    # 清零开始下一轮，并唤醒等待本轮聚合结果的线程
+    def reset(self, expected=None):
+        with self.cond:
+            self._zero()
+            for params in self.others.values():
+                params.zero_()
+            self.count = 0
+            if expected is not None:
+                self.expected = expected
+            self.round += 1
+            self.cond.notify_all()
+
+    def _zero(self):
+        self.flat.zero_()
+
+
+# 按参数分片的多进程聚合器：扁平参数向量切成agg_shards片，每片由一个进程负责，
+# 每个上传只把对应的片段发给对应的进程累加；消除掩码时各进程只展开自己那一片的掩码，
+# 聚合吞吐随核数增长。各进程算出的模型更新量写进共享内存，由服务器一次加回全局模型
+class ShardedAggregator(StreamingAggregator):
+    def __init__(self, layout, state_dict, fixed_point, expected, conf):
+        self.conf = conf
+        super(ShardedAggregator, self).__init__(layout, state_dict, fixed_point, expected)
+
+    def allocate(self):
+        layout = self.layout
+        shm = SharedMemory(create=True, size=max(layout.numel * 4, 1))
+        self.update = torch.from_numpy(np.ndarray((layout.numel,), dtype=np.float32, buffer=shm.buf))
+        self.shared_memory = shm
+        self.offsets = dict(zip(layout.names, layout.offsets))
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.shards = []
+        bits = frac_bits = None
+        if self.fixed_point is not None:
+            bits, frac_bits = self.fixed_point.bits, self.fixed_point.frac_bits
+        n_shards = self.conf["agg_shards"]
+        span = max((layout.numel + n_shards - 1) // n_shards, 1)
+        for start, end in chunk_ranges(layout.numel, span):
+            commands = context.Queue()
+            process = context.Process(target=shard_worker, daemon=True,
+                                      args=(shm.name, layout.numel, start, end, commands, self.results,
+                                            self.conf["prg"], self.conf["mask_chunk"], bits, frac_bits))
+            process.start()
+            self.shards.append((start, end, commands, process))
+        weakref.finalize(self, _stop_shards, self.shards, shm)
+
+    # 把一层中落在各个分片上的部分分别发给对应的进程
+    def _add_flat(self, name, params):
+        values = params.detach().reshape(-1).cpu().numpy()
+        start = self.offsets[name]
+        end = start + len(values)
+        for shard_start, shard_end, commands, process in self.shards:
+            lo = max(start, shard_start)
+            hi = min(end, shard_end)
+            if lo < hi:
+                # 队列在后台线程中才pickle，调用方（如ParallelTrainer的共享槽位）可能已经复用了这块内存，先拷贝
+                commands.put((ADD, lo - shard_start, values[lo - start:hi - start].copy()))
+
+    def _zero(self):
+        for shard_start, shard_end, commands, process in self.shards:
+            commands.put((RESET,))
+
+    def _gather(self, command):
+        for shard_start, shard_end, commands, process in self.shards:
+            commands.put(command)
+        for _ in self.shards:
+            self.results.get()
+        return self.update
+
+    # 浮点模式：各进程写出alpha * 和，返回整个模型的更新量
+    def aggregate(self, alpha):
+        return self._gather((AGGREGATE, alpha))
+
+    # 各进程在自己的分片上减去signed_seeds的掩码之和（ring模式下再解码），返回alpha倍的更新量
+    # step_ranges: 低比特量化时各层的[(start, end, 步长)]，None表示按frac_bits解码
+    def unmask(self, signed_seeds, alpha, step_ranges=None):
+        return self._gather((UNMASK, signed_seeds, alpha, step_ranges))
+
+
+def _stop_shards(shards, shm):
+    for shard_start, shard_end, commands, process in shards:
+        commands.put((STOP,))
+    for shard_start, shard_end, commands, process in shards:
+        process.join()
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    shm.unlink()
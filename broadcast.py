@@ -0,0 +1,139 @@
+import json
+import struct
+import threading
+import zlib
+
+import numpy as np
+import torch
+
+from mask import FlatLayout
+
+# lz4可选，没有安装时退回zlib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# lz4没有安装时退回zlib
+def resolve_codec(codec):
+    if codec == "lz4" and lz4 is None:
+        return "zlib"
+    return codec
+
+
+def compress(data, codec):
+    if codec == "lz4" and lz4 is not None:
+        return lz4.frame.compress(data)
+    return zlib.compress(data, 1)
+
+
+def decompress(data, codec):
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+# int32数组按字节平面编码：所有元素的第0字节在前、第3字节在后，
+# 增量中变化很小的高位字节连成大片的0，单独压缩；一半以上非0的字节平面基本不可压缩，直接原样保存，省去压缩时间
+# 每个平面：1字节标志（0原样，1压缩）+ 4字节长度 + 数据
+def encode_bits(data, codec):
+    planes = data.numpy().view(np.uint8).reshape(-1, 4).T
+    out = []
+    for plane in planes:
+        raw = plane.tobytes()
+        if np.count_nonzero(plane) * 2 > len(raw):
+            out.append(struct.pack('>BI', 0, len(raw)) + raw)
+        else:
+            packed = compress(raw, codec)
+            out.append(struct.pack('>BI', 1, len(packed)) + packed)
+    return b"".join(out)
+
+
+def decode_bits(data, codec):
+    planes = []
+    position = 0
+    for _ in range(4):
+        flag, length = struct.unpack('>BI', data[position:position + 5])
+        plane = data[position + 5:position + 5 + length]
+        planes.append(decompress(plane, codec) if flag else plane)
+        position += 5 + length
+    planes = np.frombuffer(b"".join(planes), dtype=np.uint8).reshape(4, -1)
+    return torch.from_numpy(np.ascontiguousarray(planes.T).view(np.int32).reshape(-1))
+
+
+# 下发消息：4字节头部长度 + json头部 + 压缩后的负载（各块压缩结果依次拼接，长度记在头部）
+def pack_message(header, payload):
+    header = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header)) + header + payload
+
+
+def unpack_message(message):
+    length = struct.unpack('>I', message[:4])[0]
+    return json.loads(message[4:4 + length].decode('utf-8')), message[4 + length:]
+
+
+# 全局模型的增量下发：客户端持有的版本还保留在版本库中时，只下发两个版本按位异或后的压缩结果
+# （没有变化的高位全为0，且可以精确还原），落后太多（或第一次连接）时下发完整快照
+class ModelBroadcaster(object):
+    def __init__(self, store):
+        self.store = store
+        self.version = store.version
+        # 当前版本下，基准版本 -> 已经编码好的消息，多个客户端共用
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    # 给持有base版本的客户端的消息（base为-1表示客户端还没有模型），返回(当前版本, 消息)
+    def message(self, base):
+        store = self.store
+        with store.lock, self.lock:
+            if store.version != self.version:
+                self.version = store.version
+                self.cache = {}
+            changes = None if base < 0 else store.changes_since(base)
+            if changes is None:
+                base = -1
+            if base not in self.cache:
+                if base == -1:
+                    changes = [encode_bits(bits, store.codec) for bits in store.current_chunks()]
+                # 整数缓冲区很小，直接放在头部
+                others = {}
+                for name, value in store.others.items():
+                    others[name] = value.tolist()
+                header = {"version": store.version, "base": base, "codec": store.codec, "others": others,
+                          "chunks": [len(chunk) for chunk in changes]}
+                self.cache[base] = pack_message(header, b"".join(changes))
+            return store.version, self.cache[base]
+
+
+# 客户端：把下发的完整快照或增量原地应用到本地模型上
+class ModelReceiver(object):
+    def __init__(self, model):
+        self.layout = FlatLayout(model.state_dict())
+        self.model = model
+        # 本地模型的浮点参数都是这个扁平向量的视图
+        self.flat = self.layout.bind(model)
+        self.version = -1
+
+    def apply(self, message):
+        header, payload = unpack_message(message)
+        if header["base"] != -1:
+            assert header["base"] == self.version
+        bits = self.flat.view(torch.int32)
+        # 逐块解压并应用
+        position = 0
+        start = 0
+        for length in header["chunks"]:
+            data = decode_bits(payload[position:position + length], header["codec"])
+            block = bits[start:start + len(data)]
+            if header["base"] == -1:
+                block.copy_(data)
+            else:
+                block.bitwise_xor_(data)
+            position += length
+            start += len(data)
+        state_dict = self.model.state_dict()
+        for name, value in header["others"].items():
+            state_dict[name].copy_(torch.tensor(value, dtype=state_dict[name].dtype))
+        self.version = header["version"]
+        return self.version
@@ -1,41 +1,47 @@
 import json
 from copy import deepcopy
-from random import randrange
 
 import numpy as np
-from torch.utils.data import DataLoader, sampler
 import torch
 
 import datasets
+from keyagree import KeyAgreement, get_group, random_secret
+from mask import FlatLayout, MaskEngine
 from server import Server
+from shamir import limb_count, share_secrets
 
 
 class SecAggregator:
-    def __init__(self, common_base, common_mod):
-        # 从0-common_mod-1选择一个随机数作为私钥
-        self.secretkey = randrange(common_mod)
-        if self.secretkey == 0:
-            self.secretkey = 1
+    def __init__(self, common_base, common_mod, exponent_bits=None):
+        # 密钥协商：随机选择私钥，由私钥生成公钥，离散大数问题，由公钥难解私钥
+        self.key_agreement = KeyAgreement(common_base, common_mod, exponent_bits)
+        self.secretkey = self.key_agreement.secretkey
         # 群的生成元
         self.base = common_base
         # 群的模数
         self.mod = common_mod
-        # 由私钥生成公钥，离散大数问题，由公钥难解私钥
-        self.pubkey = (self.base ** self.secretkey) % self.mod
+        self.exponent_bits = exponent_bits
+        # 私钥和bu的最大位数，决定秘密分享的limb个数
+        self.secret_bits = exponent_bits or common_mod.bit_length()
+        self.pubkey = self.key_agreement.pubkey
         # 自己的随机数密钥bu
-        self.sndkey = randrange(common_mod)
+        self.sndkey = random_secret(common_mod, exponent_bits)
         # 其他客户端的公钥
         self.keys = {}
         self.id = ''
+        # 扁平掩码引擎，由客户端第一次加掩码时按模型结构创建
+        self.engine = None
 
     def public_key(self):
         return self.pubkey
 
-    def set_weights(self, wghts, dims):
-        # 模型参数
-        self.weights = wghts
-        # 维度
-        self.dim = dims
+    # 每轮重新生成密钥对和bu（掉线客户端的私钥会在unmask时被重构，不能跨轮复用），掩码引擎保留
+    def refresh(self):
+        self.key_agreement = KeyAgreement(self.base, self.mod, self.exponent_bits)
+        self.secretkey = self.key_agreement.secretkey
+        self.pubkey = self.key_agreement.pubkey
+        self.sndkey = random_secret(self.mod, self.exponent_bits)
+        self.keys = {}
 
     def configure(self, base, mod):
         # 生成密钥的乘法循环群
@@ -43,94 +49,117 @@ class SecAggregator:
         self.base = base
         # 模数
         self.mod = mod
+        self.secret_bits = self.exponent_bits or mod.bit_length()
         # 由私钥生成公钥
-        self.pubkey = (self.base ** self.secretkey) % self.mod
-
-    # 生成噪声张量（加噪声） PRG伪随机生成器，seed一样，随机向量也一样
-    # def generate_weights(self, seed):
-    #     # 定义随机数种子
-    #     np.random.seed(seed)
-    #     # 生成dim维度的向量
-    #     if len(self.dim) == 0:
-    #         if self.weights.dtype == np.int64:
-    #             return np.int64(np.random.rand())
-    #         elif self.weights.dtype == np.float32:
-    #             return np.int64(np.random.rand())
-    #     elif len(self.dim) == 1:
-    #         if self.weights.dtype == np.int64:
-    #             return np.int64(np.random.rand(self.dim[0]))
-    #         elif self.weights.dtype == np.float32:
-    #             return np.float32(np.random.rand(self.dim[0]))
-    #     elif len(self.dim) == 2:
-    #         if self.weights.dtype == np.int64:
-    #             return np.int64(np.random.rand(self.dim[0], self.dim[1]))
-    #         elif self.weights.dtype == np.float32:
-    #             return np.float32(np.random.rand(self.dim[0], self.dim[1]))
-    #     elif len(self.dim) == 3:
-    #         if self.weights.dtype == np.int64:
-    #             return np.int64(np.random.rand(self.dim[0], self.dim[1], self.dim[2]))
-    #         elif self.weights.dtype == np.float32:
-    #             return np.float32(np.random.rand(self.dim[0], self.dim[1], self.dim[2]))
-    #     elif len(self.dim) == 4:
-    #         if self.weights.dtype == np.int64:
-    #             return np.int64(np.random.rand(self.dim[0], self.dim[1], self.dim[2], self.dim[3]))
-    #         elif self.weights.dtype == np.float32:
-    #             return np.float32(np.random.rand(self.dim[0], self.dim[1], self.dim[2], self.dim[3]))
-
-    # 生成加入掩码之后的参数
-
-    def generate_weights(self, seed):
-        torch.manual_seed(seed)
-        if len(self.dim) == 0:
-            return torch.tensor(0)
-        elif len(self.dim) == 1:
-            if self.weights.dtype == torch.int64:
-                return torch.randn((self.dim[0]))
-            elif self.weights.dtype == torch.float32:
-                return torch.randn((self.dim[0]), dtype=torch.float32)
-        elif len(self.dim) == 2:
-            if self.weights.dtype == torch.int64:
-                return torch.randn((self.dim[0], self.dim[1]))
-            elif self.weights.dtype == torch.float32:
-                return torch.randn((self.dim[0], self.dim[1]), dtype=torch.float32)
-        elif len(self.dim) == 3:
-            if self.weights.dtype == torch.int64:
-                return torch.randn((self.dim[0], self.dim[1], self.dim[2]))
-            elif self.weights.dtype == torch.float32:
-                return torch.randn((self.dim[0], self.dim[1], self.dim[2]), dtype=torch.float32)
-        elif len(self.dim) == 4:
-            if self.weights.dtype == torch.int64:
-                return torch.randn((self.dim[0], self.dim[1], self.dim[2], self.dim[3]))
-            elif self.weights.dtype == torch.float32:
-                return torch.randn((self.dim[0], self.dim[1], self.dim[2], self.dim[3]), dtype=torch.float32)
-
-    def prepare_weights(self, shared_keys, myid):
-        # 其他客户端的公钥
-        self.keys = shared_keys
-        self.id = myid
-        wghts = deepcopy(self.weights)
+        self.key_agreement = KeyAgreement(base, mod, secretkey=self.secretkey)
+        self.pubkey = self.key_agreement.pubkey
+
+    # 与各邻居的共享种子及符号：id大于自己的加，小于自己的减
+    def signed_seeds(self, shared_keys, myid):
+        signed_seeds = []
         for sid in shared_keys:
-            # 加掩码
+            # 共享种子每轮每个邻居只计算一次
+            seed = self.key_agreement.shared_seed(sid, shared_keys[sid])
             if sid > myid:
-                # shared_keys[sid] ** self.secretkey 生成公共密钥
-                wghts += self.generate_weights((shared_keys[sid] ** self.secretkey) % self.mod)
+                signed_seeds.append((seed, 1))
             elif sid < myid:
-                wghts -= self.generate_weights((shared_keys[sid] ** self.secretkey) % self.mod)
-        # 加自己的掩码bu
-        wghts += self.generate_weights(self.sndkey)
-        return wghts
+                signed_seeds.append((seed, -1))
+        return signed_seeds
 
-    def private_secret(self):
-        return self.generate_weights(self.sndkey)
+    # 在后台预计算组合掩码，返回future
+    def precompute(self, shared_keys, myid):
+        self.keys = shared_keys
+        self.id = myid
+        return self.engine.precompute_async(self.signed_seeds(shared_keys, myid), self.sndkey)
+
+    # 生成加入掩码之后的参数：整个diff视为一个扁平向量，每个种子只展开一次
+    def prepare_weights(self, diff, shared_keys, myid):
+        # 其他客户端的公钥
+        self.keys = shared_keys
+        self.id = myid
+        # 加两两之间的掩码和自己的掩码bu
+        return self.engine.mask(diff, self.signed_seeds(shared_keys, myid), self.sndkey)
+
+
+# 模拟时一次分享所有客户端的私钥和bu：所有秘密的多项式在一次向量化的Horner求值中算出，份额直接存进各持有者，
+# 结果与各客户端调用shared_secretkey_bu、再经网络由store_shared_secretkey_bu收下相同；
+# 每个份额是(2, limb数)的数组视图，不逐个转成列表
+# receivers: 客户端id -> 收到它份额的客户端id列表（如CCESA中拓扑图上的邻居），为None时所有客户端都收到
+def share_all_secretkey_bu(clients, t, receivers=None):
+    secrets = []
+    for c in clients:
+        secrets.append(c.sec_agg.secretkey)
+        secrets.append(c.sec_agg.sndkey)
+    n = len(clients)
+    n_limbs = limb_count(clients[0].sec_agg.secret_bits)
+    # (持有者数, 客户端数 * 2, limb数) -> (持有者数, 客户端数, 2, limb数)
+    shares = share_secrets(secrets, t, [int(c.client_id) for c in clients], n_limbs).reshape(n, n, 2, n_limbs)
+    ids = [c.client_id for c in clients]
+    position = dict(zip(ids, range(n)))
+    for j, holder in enumerate(clients):
+        if receivers is None:
+            holder.client_shared_key_bu.update(zip(ids, shares[j]))
+        else:
+            holder.client_shared_key_bu[holder.client_id] = shares[j, j]
+    if receivers is not None:
+        for i, origin_id in enumerate(ids):
+            for holder_id in receivers(origin_id):
+                j = position[holder_id]
+                clients[j].client_shared_key_bu[origin_id] = shares[j, i]
+
+
+# 按ID对训练集合的拆分：返回order中的第id段（视图，不拷贝）
+def partition(order, n_parts, id):
+    data_len = int(len(order) / n_parts)
+    return order[int(id) * data_len: (int(id) + 1) * data_len]
+
+
+# 客户端注册表：每个客户端只创建一次，各轮复用；每个客户端有自己的本地模型（创建时复制model），
+# 本地训练不会改动全局模型；所有客户端的数据划分都是同一个排列（数据集缓存中的划分索引）上的切片，
+# 不为每个客户端单独保存下标
+class ClientRegistry(object):
+    def __init__(self, conf, model, train_dataset):
+        self.conf = conf
+        self.model = model
+        self.train_dataset = train_dataset
+        self.order = datasets.index_order(train_dataset)
+        self.clients = {}
+
+    # 取出客户端（第一次时创建），并开始新的一轮
+    def get(self, client_id):
+        if client_id not in self.clients:
+            self.clients[client_id] = Client(self.conf, deepcopy(self.model), self.train_dataset, client_id,
+                                             partition(self.order, self.conf['no_models'], client_id))
+        else:
+            self.clients[client_id].new_round()
+        return self.clients[client_id]
 
 
 class Client(object):
 
-    def __init__(self, conf, model, train_dataset, id=-1):
+    # train_indices: 本客户端的数据划分（NumPy下标数组），为None时按ID切分
+    def __init__(self, conf, model, train_dataset, id=-1, train_indices=None):
         self.client_id = id
 
         # 安全聚合
-        self.sec_agg = SecAggregator(2, 17)
+        self.sec_agg = SecAggregator(*get_group(conf["key_group"]))
+        self.reset_round()
+
+        self.conf = conf
+        # 客户端本地模型(一般由服务器传输)
+        self.local_model = model
+
+        self.train_dataset = train_dataset
+
+        # 按ID对训练集合的拆分
+        if train_indices is None:
+            train_indices = partition(datasets.index_order(self.train_dataset), self.conf['no_models'], id)
+
+        self.train_indices = train_indices
+        self.train_loader = datasets.make_loader(self.train_dataset, conf["batch_size"], train_indices)
+
+    # 每轮开始时只重置与本轮有关的状态，数据划分、DataLoader和掩码引擎跨轮复用
+    def reset_round(self):
         # 最小生成树结构
         self.part_connect_graph = []
         # 客户端列表
@@ -140,34 +169,25 @@ class Client(object):
         self.client_shared_key_bu = {}
         # 存储其他客户端的公钥
         self.client_pubkey = {self.client_id: self.sec_agg.pubkey}
+        # 后台预计算组合掩码的future
+        self.mask_future = None
 
-        self.conf = conf
-        # 客户端本地模型(一般由服务器传输)
-        self.local_model = model
-
-        self.train_dataset = train_dataset
-
-        # 按ID对训练集合的拆分
-        all_range = list(range(len(self.train_dataset)))
-        data_len = int(len(self.train_dataset) / self.conf['no_models'])
-        train_indices = all_range[int(id) * data_len: (int(id) + 1) * data_len]
-
-        self.train_loader = DataLoader(self.train_dataset, batch_size=conf["batch_size"],
-                                       sampler=sampler.SubsetRandomSampler(train_indices))
+    # 新的一轮：重新生成密钥后重置本轮状态
+    def new_round(self):
+        if self.mask_future is not None:
+            self.mask_future.result()
+        self.sec_agg.refresh()
+        self.reset_round()
 
     # t-out-of-n
-    def t_out_of_n(self, t, n, k):
-        params = []
-        for i in range(t - 1):
-            a = randrange(self.sec_agg.mod)
-            params.append(a)
+    # 一次性把secrets中的每个秘密都分享给前n个客户端（素数域上的Horner求值，整体向量化）
+    def t_out_of_n(self, t, n, secrets):
+        holders = self.client_list[:n]
+        shares = share_secrets(secrets, t, [int(c.client_id) for c in holders],
+                               limb_count(self.sec_agg.secret_bits))
         part_key = {}
-        for i in range(n):
-            key = k
-            for j in range(t - 1):
-                key += params[j] * (i + 1) ** (j + 1)
-            # key = key % self.sec_agg.mod
-            part_key[self.client_list[i].client_id] = key
+        for i in range(len(holders)):
+            part_key[holders[i].client_id] = shares[i].tolist()
         return part_key
 
     # 存储来自其他客户端的份额
@@ -188,40 +208,59 @@ class Client(object):
         client_id = list(pubkey.keys())[0]
         self.client_pubkey[client_id] = pubkey[client_id]
 
+    # 消除掩码时上传给服务器的份额：在线客户端的只上传bu的份额，掉线客户端的只上传私钥的份额，
+    # 服务器收不到同一个客户端的两种份额
+    def unmask_shares(self, survivors):
+        survivors = set(survivors)
+        shares = {}
+        for origin_id, share in self.client_shared_key_bu.items():
+            # 批量分享时份额是数组视图，上传前转成列表
+            shares[origin_id] = np.asarray(share[1] if origin_id in survivors else share[0]).tolist()
+        return shares
+
     # 分享私钥和bu
     def shared_secretkey_bu(self):
-        part_secretkey = self.t_out_of_n(self.conf["t"], self.conf["k"], self.sec_agg.secretkey)
-        part_bu = self.t_out_of_n(self.conf["t"], self.conf["k"], self.sec_agg.sndkey)
-        part_secretkey_bu = {}
-        for client_id in part_secretkey:
-            part_secretkey_bu[client_id] = []
-            part_secretkey_bu[client_id].append(part_secretkey[client_id])
-            part_secretkey_bu[client_id].append(part_bu[client_id])
+        # 每个持有者的份额为[私钥的份额, bu的份额]
+        part_secretkey_bu = self.t_out_of_n(self.conf["t"], self.conf["k"],
+                                            [self.sec_agg.secretkey, self.sec_agg.sndkey])
         self.client_shared_key_bu[self.client_id] = part_secretkey_bu[self.client_id]
         # self.send_part_secretkey_bu_to_adj(part_secretkey_bu)
         return {self.client_id: part_secretkey_bu}
 
-    def mask(self, diff):
+    # 拓扑图中与自己相连的客户端的公钥
+    def shared_keys(self):
         shared_keys = {}
         for client1, client2, cost in self.part_connect_graph:
             if client1 == self.client_id:
                 shared_keys[client2] = self.client_pubkey[client2]
             if client2 == self.client_id:
                 shared_keys[client1] = self.client_pubkey[client1]
-        # for name in diff:
-        #     # item = diff[name].detach().numpy()
-        #     item = diff[name]
-        #     _item = item.detach().numpy()
-        #     dim = _item.shape
-        #     self.sec_agg.set_weights(_item, dim)
-        #     _item = self.sec_agg.prepare_weights(shared_keys, self.client_id)
-        #     diff[name] = torch.tensor(_item)
-        for name in diff:
-            item = diff[name]
-            dim = item.shape
-            self.sec_agg.set_weights(item, dim)
-            _item = self.sec_agg.prepare_weights(shared_keys, self.client_id)
-            diff[name] = _item
+        return shared_keys
+
+    # 密钥协商完成后立即在后台展开本轮的组合掩码，与本地训练并行
+    def precompute_mask(self):
+        if self.sec_agg.engine is None:
+            self.sec_agg.engine = MaskEngine(FlatLayout(self.local_model.state_dict()), self.conf,
+                                             [name for name, _ in self.local_model.named_buffers()])
+        self.mask_future = self.sec_agg.precompute(self.shared_keys(), self.client_id)
+
+    # 训练结束后只需把组合掩码加到diff上
+    def mask(self, diff):
+        if self.mask_future is None:
+            self.precompute_mask()
+        self.mask_future.result()
+        self.mask_future = None
+        fixed_point = self.sec_agg.engine.fixed_point
+        if self.conf["quant_bits"] > 0:
+            fixed_point.clipped = 0
+        self.sec_agg.engine.apply(diff)
+        if self.conf["quant_bits"] > 0 and fixed_point.clipped > 0:
+            print("客户端{}有{}个更新值超出quant_clip={}被截断".format(self.client_id, fixed_point.clipped,
+                                                                self.conf["quant_clip"]))
+
+    # 树聚合：子节点的部分和加到自己的更新上，之后只需把一个部分和转发给父节点
+    def add_partial(self, diff, partial):
+        self.sec_agg.engine.add_partial(diff, partial)
 
     # 计算时延
     def compute_communication_cost(self):
@@ -274,7 +313,7 @@ if __name__ == '__main__':
 
     with open("./utils/conf.json", 'r') as f:
         conf = json.load(f)
-    _, eval_datasets = datasets.get_dataset("./data/", conf["type"])
+    _, eval_datasets = datasets.get_dataset("./data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     server = Server(conf, eval_datasets)
     for name, params in server.global_model.state_dict().items():
         print(name)
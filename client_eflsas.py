@@ -116,6 +116,7 @@ class DeviceServerRecv(threading.Thread):
         self.client_socket = _client_socket
         self.client = _client
         self.signal = 0
+        self.buffer = b''
         self.last_id = "0"
 
     def run(self):
@@ -143,24 +144,30 @@ class DeviceServerRecv(threading.Thread):
                 self.signal = 5
                 self.last_id = _data[0:1].decode('utf-8')
             elif _data == b'unmask':
+                # 随后收到本轮的在线客户端列表
                 self.signal = 6
-                send_shared_secretkey_bu_to_server(self.client.client_id,
-                                                   self.client.client_shared_key_bu)
             else:
+                # 大整数的公钥和份额可能超过一次recv的长度，拼接成完整的json再处理
+                self.buffer += _data
+                try:
+                    data = json.loads(self.buffer)
+                except ValueError:
+                    continue
+                self.buffer = b''
                 if self.signal == 1:
-                    data = json.loads(_data)
                     self.client.part_connect_graph = data
 
                 elif self.signal == 3:
-                    data = json.loads(_data)
                     self.client.store_pubkey(data)
                     transmit_pubkey_to_adj(data, self.last_id, self.client.client_id,
                                            self.client.part_connect_graph)
                 elif self.signal == 5:
-                    data = json.loads(_data)
                     self.client.store_shared_secretkey_bu(data)
                     transmit_part_secretkey_bu_to_adj(data, self.last_id, self.client.client_id,
                                                       self.client.part_connect_graph)
+                elif self.signal == 6:
+                    # 在线客户端的只上传bu的份额，掉线客户端的只上传私钥的份额
+                    send_shared_secretkey_bu_to_server(self.client.client_id, self.client.unmask_shares(data))
                 else:
                     pass
 
@@ -210,7 +217,7 @@ if __name__ == '__main__':
     parser.add_argument('--id', type=int, default=-1)
     args = parser.parse_args()
 
-    train_datasets, _ = datasets.get_dataset("data/", conf["type"])
+    train_datasets, _ = datasets.get_dataset("data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     client = Client(conf, models.get_model(conf["model_name"]), train_datasets, args.id)
 
     device_server = DeviceServerSocket(args.ip, args.port, client)
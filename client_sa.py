@@ -58,6 +58,7 @@ class DeviceServerRecv(threading.Thread):
         self.client_socket = _client_socket
         self.client = _client
         self.signal = 0
+        self.buffer = b''
         self.last_id = "0"
 
     def run(self):
@@ -79,19 +80,25 @@ class DeviceServerRecv(threading.Thread):
             elif _data == b'transmit_part_secretkey_bu':
                 self.signal = 5
             elif _data == b'unmask':
+                # 随后收到本轮的在线客户端列表
                 self.signal = 6
-                send_shared_secretkey_bu_to_server(self.client.client_id,
-                                                   self.client.client_shared_key_bu)
             else:
+                # 大整数的公钥和份额可能超过一次recv的长度，拼接成完整的json再处理
+                self.buffer += _data
+                try:
+                    data = json.loads(self.buffer)
+                except ValueError:
+                    continue
+                self.buffer = b''
                 if self.signal == 1:
-                    data = json.loads(_data)
                     self.client.part_connect_graph = data
                 elif self.signal == 3:
-                    data = json.loads(_data)
                     self.client.store_pubkey(data)
                 elif self.signal == 5:
-                    data = json.loads(_data)
                     self.client.store_shared_secretkey_bu(data)
+                elif self.signal == 6:
+                    # 在线客户端的只上传bu的份额，掉线客户端的只上传私钥的份额
+                    send_shared_secretkey_bu_to_server(self.client.client_id, self.client.unmask_shares(data))
                 else:
                     pass
 
@@ -1,10 +1,170 @@
 
 
+import os
+
+import numpy as np
 import torch
+from torch.utils.data import DataLoader, sampler
 from torchvision import datasets, transforms
 
+# 与transforms.Normalize相同的CIFAR10均值和标准差
+CIFAR_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR_STD = (0.2023, 0.1994, 0.2010)
+
+
+# 整批的数据增强和归一化，代替逐样本的RandomCrop(padding) + RandomHorizontalFlip + ToTensor + Normalize：
+# 每个样本独立随机取裁剪位置和是否翻转，裁剪和翻转合并成uint8上的一次花式索引，之后整批转浮点并归一化
+class BatchTransform(object):
+	def __init__(self, mean=None, std=None, padding=0, flip=False):
+		self.mean = None
+		self.std = None
+		if mean is not None:
+			self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+			self.std = torch.tensor(std).view(1, -1, 1, 1)
+		self.padding = padding
+		self.flip = flip
+
+	# images: (N, C, H, W)的uint8批
+	def __call__(self, images):
+		if self.padding > 0 or self.flip:
+			images = self.crop_flip(images)
+		data = images.float().div_(255)
+		if self.mean is not None:
+			data.sub_(self.mean).div_(self.std)
+		return data
+
+	def crop_flip(self, images):
+		n, c, h, w = images.shape
+		pad = self.padding
+		if pad > 0:
+			# 与RandomCrop一致，四周补0
+			images = torch.nn.functional.pad(images, (pad, pad, pad, pad))
+		top = torch.randint(0, 2 * pad + 1, (n, 1))
+		left = torch.randint(0, 2 * pad + 1, (n, 1))
+		rows = top + torch.arange(h)
+		cols = left + torch.arange(w)
+		if self.flip:
+			# 翻转的样本列下标倒序
+			flipped = torch.rand(n, 1) < 0.5
+			cols = torch.where(flipped, cols.flip(1), cols)
+		return images[torch.arange(n).view(n, 1, 1, 1), torch.arange(c).view(1, c, 1, 1),
+					  rows.view(n, 1, h, 1), cols.view(n, 1, 1, w)]
+
+
+# 预加载的数据集：整个划分一次性解码成一个uint8张量（N, C, H, W）和标签张量，
+# 按下标列表取样时一次花式索引取出整批，再整批做transform（默认只转成[0, 1]的浮点），不经过PIL和逐样本的transform
+class PreloadedDataset(object):
+	# order: 客户端数据划分的下标排列（第i个客户端是其中连续的第i段），为None时按原顺序
+	def __init__(self, images, labels, transform=None, order=None):
+		self.images = images
+		self.labels = labels
+		self.transform = transform if transform is not None else BatchTransform()
+		self.order = order
+
+	def __len__(self):
+		return len(self.labels)
+
+	# index为整数时返回单个样本，为下标列表/数组时返回整批
+	def __getitem__(self, index):
+		index = torch.as_tensor(index, dtype=torch.long)
+		if index.dim() == 0:
+			data, target = self[index.view(1)]
+			return data[0], int(target[0])
+		return self.transform(self.images[index]), self.labels[index]
+
+
+# 把torchvision数据集的原始数据（不经过transform）转成预加载的数据集
+def preload(dataset, transform=None):
+	images = torch.as_tensor(dataset.data)
+	if images.dim() == 3:
+		# MNIST：(N, H, W) -> (N, 1, H, W)
+		images = images.unsqueeze(1)
+	else:
+		# CIFAR10：(N, H, W, C) -> (N, C, H, W)
+		images = images.permute(0, 3, 1, 2)
+	return PreloadedDataset(images.contiguous(), torch.as_tensor(dataset.targets, dtype=torch.long), transform)
+
+
+# 客户端数据划分所在的下标排列：数据集缓存中有划分索引时直接使用（内存映射），否则按原顺序
+def index_order(dataset):
+	order = getattr(dataset, "order", None)
+	if order is None:
+		order = np.arange(len(dataset))
+	return order
+
+
+# 按下标取一批样本：预加载的数据集一次索引取出，否则逐个样本取出再堆叠
+def gather(dataset, indices):
+	if isinstance(dataset, PreloadedDataset):
+		return dataset[indices]
+	samples = [dataset[int(i)] for i in indices]
+	return torch.stack([sample[0] for sample in samples]), torch.as_tensor([sample[1] for sample in samples])
+
+
+# 数据加载器：indices为None时在整个数据集上随机取样，否则只在这些下标上随机取样；
+# 预加载的数据集由批采样器每次给出一整批下标，一批只需一次索引
+def make_loader(dataset, batch_size, indices=None):
+	if indices is None:
+		index_sampler = sampler.RandomSampler(dataset)
+	else:
+		index_sampler = sampler.SubsetRandomSampler(indices)
+	if isinstance(dataset, PreloadedDataset):
+		return DataLoader(dataset, batch_size=None,
+						  sampler=sampler.BatchSampler(index_sampler, batch_size, drop_last=False))
+	return DataLoader(dataset, batch_size=batch_size, sampler=index_sampler)
+
+
+# 各划分整批进行的数据增强和归一化
+def batch_transforms(name):
+	if name == 'cifar':
+		return BatchTransform(CIFAR_MEAN, CIFAR_STD, padding=4, flip=True), BatchTransform(CIFAR_MEAN, CIFAR_STD)
+	return BatchTransform(), BatchTransform()
+
+
+# 原子地写入npy文件：多个进程同时转换时不会读到写了一半的文件
+def _save(path, array):
+	tmp = "{}.{}.tmp".format(path, os.getpid())
+	with open(tmp, 'wb') as f:
+		np.save(f, array)
+	os.replace(tmp, path)
+
+
+# 磁盘上的数据集缓存（dir/<name>-cache/）：每个划分一个连续的uint8图像数组和标签数组，
+# 训练集另有客户端划分的下标排列（固定种子的随机排列，第i个客户端取其中连续的第i段，段长由no_models在运行时决定）；
+# 第一次使用时由torchvision的原始文件转换一次，之后各进程直接内存映射（写时复制），
+# 同一主机上的进程共享页缓存并使用同一个划分，启动时不需要解析原始文件
+def load_cache(dir, name):
+	path = os.path.join(dir, name + "-cache")
+	files = ["train-images.npy", "train-labels.npy", "eval-images.npy", "eval-labels.npy"]
+	if not all(os.path.exists(os.path.join(path, f)) for f in files):
+		train_dataset, eval_dataset = get_dataset(dir, name, preload_data=True)
+		os.makedirs(path, exist_ok=True)
+		# 每个文件原子写入，全部存在即表示缓存完整
+		for split, dataset in (("train", train_dataset), ("eval", eval_dataset)):
+			_save(os.path.join(path, split + "-images.npy"), dataset.images.numpy())
+			_save(os.path.join(path, split + "-labels.npy"), dataset.labels.numpy())
+	partition_file = os.path.join(path, "train-partition.npy")
+	if not os.path.exists(partition_file):
+		n = len(np.load(os.path.join(path, "train-labels.npy"), mmap_mode='r'))
+		_save(partition_file, np.random.default_rng(0).permutation(n))
+
+	def load(f):
+		return np.load(os.path.join(path, f), mmap_mode='c')
+
+	transform_train, transform_eval = batch_transforms(name)
+	train_dataset = PreloadedDataset(torch.from_numpy(load("train-images.npy")),
+									 torch.from_numpy(load("train-labels.npy")), transform_train,
+									 load("train-partition.npy"))
+	eval_dataset = PreloadedDataset(torch.from_numpy(load("eval-images.npy")),
+									torch.from_numpy(load("eval-labels.npy")), transform_eval)
+	return train_dataset, eval_dataset
+
 
-def get_dataset(dir, name):
+# preload_data为True时返回预加载的数据集，数据增强和归一化整批进行；
+# cache为True时使用磁盘上内存映射的数据集缓存（同样是预加载的数据集）
+def get_dataset(dir, name, preload_data=False, cache=False):
+	if cache:
+		return load_cache(dir, name)
 
 	if name == 'mnist':
 		train_dataset = datasets.MNIST(dir, train=True, download=True, transform=transforms.ToTensor())
@@ -15,16 +175,20 @@ def get_dataset(dir, name):
 			transforms.RandomCrop(32, padding=4),
 			transforms.RandomHorizontalFlip(),
 			transforms.ToTensor(),
-			transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+			transforms.Normalize(CIFAR_MEAN, CIFAR_STD),
 		])
 
 		transform_test = transforms.Compose([
 			transforms.ToTensor(),
-			transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+			transforms.Normalize(CIFAR_MEAN, CIFAR_STD),
 		])
 		
 		train_dataset = datasets.CIFAR10(dir, train=True, download=True, transform=transform_train)
 		eval_dataset = datasets.CIFAR10(dir, train=False, transform=transform_test)
 		
+	if preload_data:
+		transform_train, transform_eval = batch_transforms(name)
+		train_dataset = preload(train_dataset, transform_train)
+		eval_dataset = preload(eval_dataset, transform_eval)
 	
-	return train_dataset, eval_dataset
\ No newline at end of file
+	return train_dataset, eval_dataset
@@ -103,6 +103,33 @@ class GraphStruct(object):
             self.part_connect_graph = self.generate_mst_graph()
 
 
+# 沿拓扑图做树聚合：从id最小的在线节点开始广度优先遍历，得到生成树（最小生成树即为其本身）
+# 掉线节点不参与，被它隔开的部分各自成树；返回每个节点的父节点（根为None）和子节点先于父节点的顺序
+def aggregation_tree(edges, nodes):
+    neighbors = defaultdict(list)
+    for start, stop, weight in edges:
+        if start in nodes and stop in nodes:
+            neighbors[start].append(stop)
+            neighbors[stop].append(start)
+    parent = {}
+    order = []
+    for root in sorted(nodes):
+        if root in parent:
+            continue
+        parent[root] = None
+        queue = [root]
+        while queue:
+            node = queue.pop(0)
+            order.append(node)
+            for each in sorted(neighbors[node]):
+                if each not in parent:
+                    parent[each] = node
+                    queue.append(each)
+    # 广度优先序的逆序保证子节点都排在父节点之前
+    order.reverse()
+    return parent, order
+
+
 if __name__ == '__main__':
     g = GraphStruct()
     g.communication_cost([])
@@ -0,0 +1,75 @@
+import secrets
+
+# RFC 3526 MODP群（安全素数p，生成元2）
+MODP_1536 = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA237327FFFFFFFFFFFFFFFF", 16)
+
+MODP_2048 = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF", 16)
+
+MODP_3072 = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AAAC42DAD33170D04507A33"
+    "A85521ABDF1CBA64ECFB850458DBEF0A8AEA71575D060C7DB3970F85A6E1E4C7"
+    "ABF5AE8CDB0933D71E8C94E04A25619DCEE3D2261AD2EE6BF12FFA06D98A0864"
+    "D87602733EC86A64521F2B18177B200CBBE117577A615D6C770988C0BAD946E2"
+    "08E24FA074E5AB3143DB5BFCE0FD108E4B82D120A93AD2CAFFFFFFFFFFFFFFFF", 16)
+
+# 群名 -> (生成元, 模数, 私钥位数)；私钥位数为None时在[1, 模数)中取私钥
+# MODP群使用短指数，256位私钥已足够，且便于t-out-of-n分享
+GROUPS = {
+    "toy": (2, 17, None),
+    "modp1536": (2, MODP_1536, 256),
+    "modp2048": (2, MODP_2048, 256),
+    "modp3072": (2, MODP_3072, 256),
+}
+
+
+def get_group(name):
+    return GROUPS[name]
+
+
+# 随机私钥/种子，取自操作系统的密码学安全随机数，范围[1, mod)或[1, 2^exponent_bits)
+def random_secret(mod, exponent_bits=None):
+    if exponent_bits is None:
+        return secrets.randbelow(mod - 1) + 1
+    return secrets.randbelow((1 << exponent_bits) - 1) + 1
+
+
+# Diffie-Hellman密钥协商：公钥 = base^secretkey mod mod，
+# 共享种子 = pubkey_peer^secretkey mod mod，每个对端每轮只计算一次
+class KeyAgreement(object):
+    def __init__(self, base, mod, exponent_bits=None, secretkey=None):
+        self.base = base
+        self.mod = mod
+        if secretkey is None:
+            secretkey = random_secret(mod, exponent_bits)
+        self.secretkey = secretkey
+        # 三参数pow边乘边取模
+        self.pubkey = pow(base, secretkey, mod)
+        # (对端id, 对端公钥) -> 共享种子
+        self.shared_seeds = {}
+
+    def shared_seed(self, peer_id, peer_pubkey):
+        key = (peer_id, peer_pubkey)
+        if key not in self.shared_seeds:
+            self.shared_seeds[key] = pow(peer_pubkey, self.secretkey, self.mod)
+        return self.shared_seeds[key]
@@ -1,6 +1,9 @@
-﻿from client import *
+﻿from copy import deepcopy
+
+from client import *
 import datasets
 from graph import GraphStruct
+from simulate import make_trainer, train_clients
 
 
 if __name__ == '__main__':
@@ -17,21 +20,28 @@ if __name__ == '__main__':
         # 加载json文件
         conf = json.load(f)
 
-    train_datasets, eval_datasets = datasets.get_dataset("./data/", conf["type"])
+    train_datasets, eval_datasets = datasets.get_dataset("./data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
 
     # 开启服务器
     server = Server(conf, eval_datasets)
+    # 本驱动不加掩码，只支持浮点聚合
+    server.require_float_mode()
 
     # 客户端列表
     clients = []
 
-    # 添加10个客户端
+    # 添加10个客户端，每个客户端在自己的模型副本上训练
     for c in range(conf["no_models"]):
-        clients.append(Client(conf, server.global_model, train_datasets, c + 1))
+        clients.append(Client(conf, deepcopy(server.global_model), train_datasets, c + 1))
 
     # 生成图
     # generate_graph = GraphStruct()
 
+    # 流式聚合器，各轮复用同一个累加器
+    aggregator = server.new_aggregator()
+    # 本地训练的模拟方式：进程池并行、vmap向量化批量训练，或逐个训练（trainer为None）
+    trainer = make_trainer(server.global_model, train_datasets, conf)
+
     # 全局模型训练，全局迭代次数 conf["global_epochs"]
     for e in range(conf["global_epochs"]):
         print("Global Epoch %d" % e)
@@ -80,16 +90,11 @@ if __name__ == '__main__':
         #     for _c in candidates:
         #         _c.store_shared_secretkey_bu(shared)
 
-        weight_accumulator = {}
-        # torch.nn.Module模块中的state_dict变量存放训练过程中需要学习的权重和偏执系数，
-        # state_dict作为python的字典对象将每一层的参数映射成tensor张量
-        for name, params in server.global_model.state_dict().items():
-            # 生成一个和参数矩阵大小相同的0矩阵
-            weight_accumulator[name] = torch.zeros_like(params)
+        # 流式聚合：每个客户端训练完就把更新累加进聚合器，随即释放，内存与客户端数量无关
+        aggregator.reset(len(candidates))
 
         # 遍历客户端，每个客户端本地训练模型 加掩码mask
-        for c in candidates:
-            diff = c.local_train(server.global_model)
+        for c, diff in train_clients(candidates, server.global_model, trainer):
             # mask
             # c.mask(diff)
 
@@ -97,11 +102,11 @@ if __name__ == '__main__':
             # ...
 
             # 根据客户端的参数差值字典更新总体权重
-            for name, params in server.global_model.state_dict().items():
-                weight_accumulator[name].add_(diff[name])
+            aggregator.add(diff)
+            del diff
 
         # 聚合
-        server.model_aggregate(weight_accumulator)
+        server.model_aggregate(aggregator)
         # unmask
         # 手动收集(实验)
         # for c in candidates:
@@ -0,0 +1,259 @@
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+
+from prg import chunk_ranges, expand_normal, expand_shared, expand_uniform, get_pool, get_prg
+from quantize import FixedPoint, StochasticQuantizer
+
+# 后台预计算掩码的线程池（与prg中展开用的线程池分开，避免互相等待）
+_precompute_pool = ThreadPoolExecutor()
+
+
+# 模型参数的扁平化布局：把state_dict中所有浮点层按顺序拼成一个连续向量
+# 整数缓冲区（如num_batches_tracked）不加掩码，保持原样
+class FlatLayout(object):
+    def __init__(self, state_dict):
+        self.names = []
+        self.shapes = []
+        self.offsets = []
+        self.numel = 0
+        self.device = torch.device("cpu")
+        for name, data in state_dict.items():
+            if not data.is_floating_point():
+                continue
+            if len(self.names) == 0:
+                self.device = data.device
+            self.names.append(name)
+            self.shapes.append(data.shape)
+            self.offsets.append(self.numel)
+            self.numel += data.numel()
+
+    def items(self):
+        for name, shape, offset in zip(self.names, self.shapes, self.offsets):
+            yield name, shape, offset, offset + shape.numel()
+
+    def empty(self):
+        return torch.empty(self.numel, dtype=torch.float32, device=self.device)
+
+    # 把字典中的各层拷贝进扁平向量
+    def flatten(self, state_dict, out):
+        for name, shape, start, end in self.items():
+            out[start:end].copy_(state_dict[name].reshape(-1))
+        return out
+
+    # 让模型的浮点参数和缓冲区都成为同一个连续扁平向量的视图，返回该向量
+    # 之后对扁平向量的原地修改直接反映到模型上，反之亦然
+    # out为None时新分配（内存中）的扁平向量，也可以传入内存映射的向量
+    # load为False时不把模型当前的值写入out（out中已经是要使用的值，如共享内存中发布的全局模型）
+    def bind(self, module, out=None, load=True):
+        flat = self.empty() if out is None else out
+        if load:
+            self.flatten(module.state_dict(), flat)
+        for name, shape, start, end in self.items():
+            prefix, _, attr = name.rpartition('.')
+            owner = module.get_submodule(prefix)
+            view = flat[start:end].view(shape)
+            if attr in owner._parameters:
+                owner._parameters[attr].data = view
+            else:
+                owner._buffers[attr] = view
+        return flat
+
+    # 把扁平向量切分成各层视图写回字典（不拷贝）
+    def unflatten(self, flat, state_dict):
+        for name, shape, start, end in self.items():
+            state_dict[name] = flat[start:end].view(shape)
+        return state_dict
+
+
+# 引擎回收时释放共享内存；若组合掩码的张量仍被外部引用，只取消链接，映射随进程退出释放
+def _release_shared_memory(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    shm.unlink()
+
+
+# 扁平掩码引擎：每个种子只在整个模型向量上展开一次，原地累加到预分配的缓冲区
+# 内存占用为O(模型大小)，与邻居数量无关
+# plain_names: 低比特量化时不做量化的浮点缓冲区（模型的named_buffers）
+class MaskEngine(object):
+    def __init__(self, layout, conf, plain_names=()):
+        self.layout = layout
+        # 计数器模式PRG后端及分块并行展开参数
+        self.prg = conf["prg"]
+        self.chunk_size = conf["mask_chunk"]
+        self.workers = conf["mask_workers"]
+        # 大于0时用进程池展开组合掩码（稠密拓扑下邻居多时使用）
+        self.processes = conf["mask_processes"]
+        # ring模式：更新量化为Z_2^ring_bits上的定点数，掩码为环上均匀分布，掩码可以精确抵消
+        self.fixed_point = None
+        dtype = torch.float32
+        if conf["quant_bits"] > 0:
+            # 随机舍入的低比特量化，同样在整数环上加掩码，环的位宽由量化位数和客户端数决定
+            self.fixed_point = StochasticQuantizer(conf["quant_bits"], conf["k"], layout, conf["quant_clip"],
+                                                   plain_names)
+            dtype = torch.int64
+        elif conf["agg_mode"] == "ring":
+            self.fixed_point = FixedPoint(conf["ring_bits"], conf["frac_bits"])
+            dtype = torch.int64
+        self.dtype = dtype
+        # 缓冲区按需分配：客户端用到buffer/scratch/combined/output，服务器只在ring模式下用buffer存放整数环上的和
+        # 输出缓冲区
+        self.buffer = None
+        # 展开单个种子的临时缓冲区，所有种子复用（在CPU上生成）
+        self.scratch = None
+        # 预计算好的组合掩码：两两掩码与bu之和
+        self.combined = None
+        # 多进程模式下组合掩码所在的共享内存
+        self.shared_memory = None
+        # ring模式下上传用的紧凑整数缓冲区
+        self.output = None
+
+    def _empty(self, dtype=None, device=None):
+        return torch.empty(self.layout.numel, dtype=dtype or self.dtype, device=device or self.layout.device)
+
+    def get_buffer(self):
+        if self.buffer is None:
+            self.buffer = self._empty()
+        return self.buffer
+
+    def get_output(self):
+        if self.output is None:
+            self.output = self.get_buffer()
+            if self.fixed_point is not None and self.fixed_point.wire_dtype != self.dtype:
+                self.output = self._empty(dtype=self.fixed_point.wire_dtype)
+        return self.output
+
+    # PRG伪随机生成器，seed一样，随机向量也一样；各块按(seed, offset)独立并行生成
+    def expand(self, seed, out):
+        prg = get_prg(self.prg, seed)
+        if self.fixed_point is None:
+            expand_normal(prg, out.numpy(), self.chunk_size, self.workers)
+        else:
+            expand_uniform(prg, out.numpy(), self.fixed_point.bits, self.chunk_size, self.workers)
+        return out
+
+    # out += sign * PRG(seed)
+    def accumulate(self, seed, sign, out):
+        if self.scratch is None:
+            self.scratch = self._empty(device=torch.device("cpu"))
+        self.expand(seed, self.scratch)
+        out.add_(self.scratch.to(out.device), alpha=sign)
+        if self.fixed_point is not None:
+            self.fixed_point.wrap_(out)
+        return out
+
+    # 组合掩码只依赖密钥和模型结构，与训练数据无关，可以在训练之前算好
+    # signed_seeds: [(seed, +1/-1), ...] 两两之间的共享掩码；self_seed: 自己的掩码bu
+    def precompute(self, signed_seeds, self_seed):
+        if self.processes > 0:
+            return self._precompute_shared(signed_seeds, self_seed)
+        if self.combined is None:
+            self.combined = self._empty()
+        self.combined.zero_()
+        for seed, sign in signed_seeds:
+            self.accumulate(seed, sign, self.combined)
+        self.accumulate(self_seed, 1, self.combined)
+        return self.combined
+
+    # 多进程版本：组合掩码放在共享内存中，各进程展开不同的参数区间直接写入
+    def _precompute_shared(self, signed_seeds, self_seed):
+        if self.combined is None:
+            numpy_dtype = np.float32 if self.fixed_point is None else np.int64
+            shm = SharedMemory(create=True, size=max(self.layout.numel * np.dtype(numpy_dtype).itemsize, 1))
+            weakref.finalize(self, _release_shared_memory, shm)
+            self.combined = torch.from_numpy(np.ndarray((self.layout.numel,), dtype=numpy_dtype, buffer=shm.buf))
+            self.shared_memory = shm
+        bits = None if self.fixed_point is None else self.fixed_point.bits
+        expand_shared(self.prg, signed_seeds + [(self_seed, 1)], self.shared_memory, self.layout.numel,
+                      self.combined.numpy().dtype, self.chunk_size, self.processes, bits)
+        return self.combined
+
+    # 在后台线程中预计算组合掩码，返回future
+    def precompute_async(self, signed_seeds, self_seed):
+        return _precompute_pool.submit(self.precompute, signed_seeds, self_seed)
+
+    # 把预计算好的组合掩码一次性加到更新上
+    def apply(self, diff):
+        buffer = self.get_buffer()
+        output = self.get_output()
+        if self.fixed_point is None:
+            self.layout.flatten(diff, buffer)
+            buffer.add_(self.combined.to(buffer.device))
+        else:
+            plain = {}
+            for name, shape, start, end in self.layout.items():
+                if name in self.fixed_point.plain_names:
+                    # 不量化的层以浮点明文上传，环中的位置不上传；
+                    # diff可能是训练进程共享槽位的视图，缓冲区很小，拷贝一份
+                    plain[name] = diff[name].clone()
+                    buffer[start:end].zero_()
+                else:
+                    self.fixed_point.encode(diff[name].reshape(-1), buffer[start:end], name)
+            self.fixed_point.wrap_(buffer.add_(self.combined.to(buffer.device)))
+            if output is not buffer:
+                self.fixed_point.pack(buffer, output)
+            self.layout.unflatten(output, diff)
+            diff.update(plain)
+            return diff
+        return self.layout.unflatten(output, diff)
+
+    # 树聚合：把子节点转发来的（加掩码的）部分和加到自己要上传的diff上
+    def add_partial(self, diff, partial):
+        output = self.get_output()
+        plain_names = set() if self.fixed_point is None else self.fixed_point.plain_names
+        for name, shape, start, end in self.layout.items():
+            if name not in plain_names:
+                output[start:end].add_(partial[name].reshape(-1).to(output.device))
+        if self.fixed_point is not None:
+            self.fixed_point.wrap_packed_(output)
+        # 不加掩码的整数缓冲区（以及不量化的浮点缓冲区）直接相加
+        for name in diff:
+            if name in partial and (name not in self.layout.names or name in plain_names):
+                diff[name].add_(partial[name])
+        return diff
+
+    def mask(self, diff, signed_seeds, self_seed):
+        self.precompute(signed_seeds, self_seed)
+        return self.apply(diff)
+
+    # 一组种子的掩码在[offset, offset + count)上的部分和（numpy数组）
+    def _partial_sum(self, group, offset, count):
+        if self.fixed_point is None:
+            total = np.zeros(count, dtype=np.float32)
+        else:
+            total = np.zeros(count, dtype=np.int64)
+        for prg, sign in group:
+            if self.fixed_point is None:
+                values = prg.normal(offset, count)
+            else:
+                values = prg.uniform(offset, count, bits=self.fixed_point.bits)
+            if sign > 0:
+                total += values
+            else:
+                total -= values
+        return total
+
+    # 流式展开多个种子的掩码之和：把模型向量按chunk_size分块，每块内把种子分给线程池中的各个线程
+    # 分别求部分和再归约，依次产出(start, end, 这一块的和)；内存只与块大小和线程数有关，与模型大小无关
+    def stream(self, signed_seeds, chunk_size):
+        workers = self.workers or os.cpu_count()
+        pool = get_pool(self.workers)
+        n_groups = max(min(len(signed_seeds), workers), 1)
+        groups = []
+        for i in range(n_groups):
+            groups.append([(get_prg(self.prg, seed), sign) for seed, sign in signed_seeds[i::n_groups]])
+        for start, end in chunk_ranges(self.layout.numel, chunk_size):
+            futures = [pool.submit(self._partial_sum, group, start, end - start) for group in groups]
+            total = futures[0].result()
+            for f in futures[1:]:
+                total += f.result()
+            if self.fixed_point is not None:
+                total &= self.fixed_point.modulus_mask
+            yield start, end, torch.from_numpy(total)
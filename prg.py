@@ -0,0 +1,163 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# 每个Philox计数器块输出4个64位随机数
+PHILOX_BLOCK = 4
+# 每个BLAKE2b分组输出8个64位随机数
+BLAKE2B_BLOCK = 8
+
+_pools = {}
+_process_pools = {}
+
+
+# 把任意大小的整数种子压缩成16字节密钥
+def seed_key(seed):
+    return hashlib.sha256(str(seed).encode('utf-8')).digest()[:16]
+
+
+# 计数器模式伪随机生成器：第i个输出只由(seed, i)决定，
+# 因此掩码的任意一段都可以从(seed, offset)独立生成
+class CounterPRG(object):
+    def __init__(self, seed):
+        self.key = seed_key(seed)
+
+    # 第offset个开始的count个64位原始输出
+    def raw(self, offset, count):
+        raise NotImplementedError
+
+    # 第offset个开始的count个标准正态随机数，每个元素只消耗一个64位输出（Box-Muller）
+    def normal(self, offset, count, out=None):
+        bits = self.raw(offset, count)
+        u1 = ((bits >> np.uint64(32)).astype(np.float64) + 1.0) / 4294967296.0
+        u2 = (bits & np.uint64(0xFFFFFFFF)).astype(np.float64) / 4294967296.0
+        z = np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
+        if out is None:
+            return z.astype(np.float32)
+        out[:] = z
+        return out
+
+    # 第offset个开始的count个[0, 2^bits)上的均匀随机整数（整数环掩码）
+    def uniform(self, offset, count, out=None, bits=32):
+        values = self.raw(offset, count) & np.uint64((1 << bits) - 1)
+        if out is None:
+            return values.astype(np.int64)
+        out[:] = values
+        return out
+
+
+# NumPy的Philox计数器生成器，advance直接跳到指定计数器位置
+class PhiloxPRG(CounterPRG):
+    def raw(self, offset, count):
+        bit_generator = np.random.Philox(key=int.from_bytes(self.key, 'little'))
+        bit_generator.advance(offset // PHILOX_BLOCK)
+        skip = offset % PHILOX_BLOCK
+        return bit_generator.random_raw(skip + count)[skip:]
+
+
+# 带密钥的BLAKE2b计数器模式流，只依赖标准库
+class Blake2bPRG(CounterPRG):
+    def raw(self, offset, count):
+        first = offset // BLAKE2B_BLOCK
+        last = (offset + count + BLAKE2B_BLOCK - 1) // BLAKE2B_BLOCK
+        stream = b''.join(hashlib.blake2b(i.to_bytes(8, 'little'), key=self.key).digest()
+                          for i in range(first, last))
+        skip = offset % BLAKE2B_BLOCK
+        return np.frombuffer(stream, dtype='<u8')[skip:skip + count].astype(np.uint64)
+
+
+PRG_BACKENDS = {
+    "philox": PhiloxPRG,
+    "blake2b": Blake2bPRG,
+}
+
+
+def get_prg(name, seed):
+    return PRG_BACKENDS[name](seed)
+
+
+# 把[0, numel)切分成大小为chunk_size的区间
+def chunk_ranges(numel, chunk_size):
+    for start in range(0, numel, chunk_size):
+        yield start, min(start + chunk_size, numel)
+
+
+# 掩码展开共用的线程池，workers为0时使用全部核
+def get_pool(workers):
+    if workers not in _pools:
+        _pools[workers] = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+    return _pools[workers]
+
+
+# 把一个掩码流stream(offset, count, out)分块并行展开到out（numpy数组）中
+def expand_stream(stream, out, chunk_size, workers=0, offset=0):
+    pool = get_pool(workers)
+    futures = [pool.submit(stream, offset + start, end - start, out[start:end])
+               for start, end in chunk_ranges(len(out), chunk_size)]
+    for f in futures:
+        f.result()
+    return out
+
+
+def expand_normal(prg, out, chunk_size, workers=0, offset=0):
+    return expand_stream(prg.normal, out, chunk_size, workers, offset)
+
+
+def expand_uniform(prg, out, bits, chunk_size, workers=0, offset=0):
+    return expand_stream(partial(prg.uniform, bits=bits), out, chunk_size, workers, offset)
+
+
+# 多进程展开用的进程池；使用spawn，子进程只需导入本模块（不依赖torch）
+def get_process_pool(processes):
+    if processes not in _process_pools:
+        _process_pools[processes] = ProcessPoolExecutor(max_workers=processes,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+    return _process_pools[processes]
+
+
+# 把所有种子的掩码在[offset, offset + len(out))上的和写进out（numpy数组），bits为None时为正态掩码
+def expand_sum(backend, signed_seeds, out, offset, chunk_size, bits=None):
+    prgs = [(get_prg(backend, seed), sign) for seed, sign in signed_seeds]
+    for lo, hi in chunk_ranges(len(out), chunk_size):
+        block = out[lo:hi]
+        block[:] = 0
+        for prg, sign in prgs:
+            if bits is None:
+                values = prg.normal(offset + lo, hi - lo)
+            else:
+                values = prg.uniform(offset + lo, hi - lo, bits=bits)
+            if sign > 0:
+                block += values
+            else:
+                block -= values
+        if bits is not None:
+            block &= (1 << bits) - 1
+    return out
+
+
+# 子进程：把所有种子的掩码在[start, end)上的和直接写进共享内存中的输出向量
+def _expand_shared_range(shm_name, numel, dtype, backend, signed_seeds, start, end, chunk_size, bits):
+    shm = SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray((numel,), dtype=dtype, buffer=shm.buf)
+        expand_sum(backend, signed_seeds, out[start:end], start, chunk_size, bits)
+        del out
+    finally:
+        shm.close()
+
+
+# 用进程池展开sum(sign * PRG(seed))：各进程负责互不相交的参数区间，直接写进共享内存out_shm，
+# 区间之间没有重叠，所有进程结束时结果即已归约完毕
+def expand_shared(backend, signed_seeds, out_shm, numel, dtype, chunk_size, processes, bits=None):
+    pool = get_process_pool(processes)
+    span = (numel + processes - 1) // processes
+    futures = [pool.submit(_expand_shared_range, out_shm.name, numel, np.dtype(dtype).str, backend,
+                           signed_seeds, start, end, chunk_size, bits)
+               for start, end in chunk_ranges(numel, max(span, 1))]
+    for f in futures:
+        f.result()
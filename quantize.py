@@ -0,0 +1,104 @@
+import math
+
+import torch
+
+# 上传时可用的整数类型，按位宽从小到大
+WIRE_DTYPES = [(8, torch.int8), (16, torch.int16), (32, torch.int32), (64, torch.int64)]
+
+
+# 定点数编码：把浮点更新量化到整数环Z_2^bits上，
+# 低frac_bits位是小数部分，负数用补码表示，加法自动回绕
+class FixedPoint(object):
+    def __init__(self, bits, frac_bits):
+        # int64上做回绕加法，环的位宽不能超过62
+        assert 0 < frac_bits < bits <= 62
+        self.bits = bits
+        self.frac_bits = frac_bits
+        self.scale = float(1 << frac_bits)
+        self.modulus_mask = (1 << bits) - 1
+        # 上传时使用能容纳环元素的最小整数类型，32位以内只占float64的一半
+        for wire_bits, wire_dtype in WIRE_DTYPES:
+            if bits <= wire_bits:
+                break
+        self.wire_bits = wire_bits
+        self.wire_dtype = wire_dtype
+        # 不做整数编码、以浮点明文与整数缓冲区一起累加的层（低比特量化时的浮点缓冲区）
+        self.plain_names = set()
+
+    # 取模2^bits（原地）
+    def wrap_(self, q):
+        return q.bitwise_and_(self.modulus_mask)
+
+    # x -> round(x * 2^frac_bits) mod 2^bits，写入int64的out
+    def encode(self, x, out, name=None):
+        out.copy_(torch.round(x * self.scale))
+        return self.wrap_(out)
+
+    # 环上元素按补码解释为有符号数
+    def signed(self, q):
+        return q - ((q >> (self.bits - 1)) << self.bits)
+
+    # 环上元素按补码解释为有符号数，再除以2^frac_bits；start为q在扁平向量中的起始位置
+    def decode(self, q, start=0):
+        return self.signed(q).to(torch.float64).div_(self.scale).to(torch.float32)
+
+    # 分片进程解码用的[(start, end, 步长)]，None表示统一除以2^frac_bits
+    def step_ranges(self):
+        return None
+
+    # 打包成上传类型：环元素mod 2^bits不变，位宽与上传类型相同时需要把高半区折成负数（原地修改q）
+    def pack(self, q, out):
+        if self.bits == self.wire_bits:
+            half = 1 << (self.bits - 1)
+            q.add_(half).bitwise_and_(self.modulus_mask).sub_(half)
+        return out.copy_(q)
+
+    # 已打包的环元素相加后原地回绕：位宽与上传类型相同时整数加法本身就是模2^bits
+    def wrap_packed_(self, q):
+        if self.bits != self.wire_bits:
+            self.wrap_(q)
+        return q
+
+
+# 随机舍入的低比特量化：参数的更新截断到[-clip, clip]后按步长clip / qmax量化到quant_bits位有符号整数（无偏），
+# clip是更新量的绝对上界（conf中的quant_clip，与学习率和本地轮数有关，不随模型权重缩放），
+# 步长只由配置决定，所有客户端和服务器天然一致；超出clip被截断的个数记在clipped中，说明clip设得太小
+# 环的位宽取quant_bits + ceil(log2(n_clients))，n个客户端的和不会溢出，可以直接在整数环上加掩码；
+# 上传类型是能容纳环元素的最小整数类型，8位量化、不超过256个客户端时只需int16
+# plain_names中的浮点缓冲区（BatchNorm的running_mean/var）更新量级与参数无关、没有事先可知的上界，
+# 不做量化，与num_batches_tracked一样以浮点明文单独累加（不加掩码），环中对应位置编码为0、解码步长为0
+class StochasticQuantizer(FixedPoint):
+    def __init__(self, quant_bits, n_clients, layout, clip, plain_names=()):
+        if not 0 < clip < math.inf:
+            raise ValueError("quant_clip must be a positive finite bound on each update value, got {}".format(clip))
+        bits = quant_bits + max(math.ceil(math.log2(max(n_clients, 1))), 1)
+        super(StochasticQuantizer, self).__init__(bits, 1)
+        self.quant_bits = quant_bits
+        self.qmax = (1 << (quant_bits - 1)) - 1
+        self.layout = layout
+        self.plain_names = set(plain_names) & set(layout.names)
+        self.steps = {}
+        for name in layout.names:
+            self.steps[name] = 0.0 if name in self.plain_names else clip / self.qmax
+        self.clipped = 0
+
+    # x -> clamp(floor(x / step + u), -qmax, qmax) mod 2^bits，u ~ U[0, 1)
+    def encode(self, x, out, name=None):
+        q = x / self.steps[name]
+        q.add_(torch.rand_like(q)).floor_()
+        self.clipped += int((q.abs() > self.qmax).sum())
+        q.clamp_(-self.qmax, self.qmax)
+        out.copy_(q)
+        return self.wrap_(out)
+
+    def decode(self, q, start=0):
+        values = self.signed(q).to(torch.float64)
+        end = start + len(q)
+        for name, shape, lo, hi in self.layout.items():
+            lo, hi = max(lo, start), min(hi, end)
+            if lo < hi:
+                values[lo - start:hi - start].mul_(self.steps[name])
+        return values.to(torch.float32)
+
+    def step_ranges(self):
+        return [(start, end, self.steps[name]) for name, shape, start, end in self.layout.items()]
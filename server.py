@@ -1,8 +1,16 @@
 from copy import deepcopy
 
-import models, torch
+import datasets, models, torch
 import numpy as np
 
+from aggregator import ShardedAggregator, StreamingAggregator
+from keyagree import KeyAgreement, get_group
+from mask import FlatLayout, MaskEngine
+from prg import chunk_ranges
+from shamir import reconstruct_secrets
+from storage import flat_tensor
+from store import ModelStore
+
 
 class Server(object):
 
@@ -18,11 +26,38 @@ class Server(object):
         self.client_dict = {}
         self.client_list = []
 
+        # 掉线客户端重构出的密钥协商，缓存与邻居的共享种子
+        self.recovered_keys = {}
+        # 客户端的公钥，用于重新生成掉线客户端的两两掩码
+        self.client_pubkey = {}
+
         self.conf = conf
 
         self.global_model = models.get_model(self.conf["model_name"])
 
-        self.eval_loader = torch.utils.data.DataLoader(eval_dataset, batch_size=self.conf["batch_size"], shuffle=True)
+        # 与客户端一致的扁平掩码引擎，用于消除bu掩码
+        self.mask_engine = MaskEngine(FlatLayout(self.global_model.state_dict()), self.conf,
+                                      [name for name, _ in self.global_model.named_buffers()])
+        # 全局模型的浮点参数和缓冲区都是这个连续扁平向量的视图，聚合时整体做一次加法
+        # mmap_dir不为空时该向量放在内存映射文件中，模型可以大于内存
+        layout = self.mask_engine.layout
+        self.global_flat = layout.bind(self.global_model, flat_tensor(layout.numel, torch.float32, layout.device,
+                                                                      self.conf["mmap_dir"], "global_model"))
+        # 全局模型的版本库：只有需要下发模型的服务器（socket/zmq）才通过new_model_store创建
+        self.model_store = None
+        # ring模式下本轮整数环上的和（即聚合器的累加器，不拷贝），等unmask消除bu掩码后再解码
+        self.ring_sum = None
+        # 最近一次model_aggregate使用的聚合器
+        self.last_aggregator = None
+        # 分片聚合器（agg_shards大于0时）
+        self.sharded_aggregator = None
+
+        self.eval_loader = datasets.make_loader(eval_dataset, self.conf["batch_size"])
+
+    # 创建全局模型的版本库，之后每轮聚合完成后提交
+    def new_model_store(self):
+        self.model_store = ModelStore(self.mask_engine.layout, self.global_flat, self.global_model, self.conf)
+        return self.model_store
 
     def reveive_msg(self):
         pass
@@ -38,146 +73,195 @@ class Server(object):
                 self.all_part_secretkey_bu[client_id] = [
                     {origin_client_id: client_shared_key_bu[origin_client_id][client_id]}]
 
-    # 根据份额重建密钥和bu
+    # 根据份额（[secretkey份额, bu份额]）重建密钥和bu：取id最小的t个份额在素数域上插值
     def reconstruct_secretkey_bu(self, t, client_shared_key_bu):
-        for i in range(len(client_shared_key_bu)):
-            for j in range(i + 1, len(client_shared_key_bu)):
-                if list(client_shared_key_bu[j].keys())[0] < list(client_shared_key_bu[i].keys())[0]:
-                    temp = client_shared_key_bu[i]
-                    client_shared_key_bu[i] = client_shared_key_bu[j]
-                    client_shared_key_bu[j] = temp
-
-        if len(client_shared_key_bu) >= t:
-            y_bu = []
-            y_secretkey = []
-            id_list = []
-            for item in client_shared_key_bu:
+        secretkey_bu = self.reconstruct_all_secretkey_bu(t, {"": client_shared_key_bu})
+        return secretkey_bu.get("", [])
+
+    # 批量重建：持有者相同的客户端共用一组拉格朗日系数，在一次向量化计算中恢复所有私钥和bu
+    # all_part_secretkey_bu: {客户端id: [{持有者id: [secretkey份额, bu份额]}, ...]}，返回{客户端id: [secretkey, bu]}
+    # single为True时每个份额只有一个秘密（unmask时按需上传的私钥或bu的份额），返回{客户端id: 秘密}
+    # 份额不足t个的客户端无法重建，抛出ValueError
+    def reconstruct_all_secretkey_bu(self, t, all_part_secretkey_bu=None, single=False):
+        if all_part_secretkey_bu is None:
+            all_part_secretkey_bu = self.all_part_secretkey_bu
+        groups = {}
+        for client_id in all_part_secretkey_bu:
+            parts = {}
+            for item in all_part_secretkey_bu[client_id]:
                 _id = list(item.keys())[0]
-                id_list.append(_id)
-                # [secretkey, bu]
-                y_secretkey.append(item[_id][0])
-                y_bu.append(item[_id][1])
-            A = []
-            for i in range(t):
-                a = [1]
-                for j in range(t - 1):
-                    # a.append((i + 1) ** (j + 1))
-                    a.append(int(id_list[i]) ** (j + 1))
-                A.append(a)
-            A_bu = []
-            A_secretkey = []
-            for i in range(t):
-                a_bu = [y_bu[i]]
-                a_secretkey = [y_secretkey[i]]
-                for j in range(t - 1):
-                    a_bu.append(A[i][j + 1])
-                    a_secretkey.append(A[i][j + 1])
-                A_bu.append(a_bu)
-                A_secretkey.append(a_secretkey)
-            bu = np.linalg.det(A_bu) / np.linalg.det(A)
-            k = np.linalg.det(A_secretkey) / np.linalg.det(A)
-            # 取整
-            if k - int(k) > 0.9:
-                k = int(k) + 1
-            else:
-                k = int(k)
-            if bu - int(bu) > 0.9:
-                bu = int(bu) + 1
-            else:
-                bu = int(bu)
-            return [k, bu]
-        else:
-            pass
-        return []
-
-    # 生成噪声张量（加噪声） PRG伪随机生成器，seed一样，随机向量也一样
-    # def generate_weights(self, seed, dim, _type):
-    #     # 定义随机数种子
-    #     np.random.seed(seed)
-    #     # 生成dim维度的向量
-    #     if len(dim) == 0:
-    #         if _type == np.int64:
-    #             return np.int64(np.random.rand())
-    #         if _type == np.float32:
-    #             return np.int64(np.random.rand())
-    #     if len(dim) == 1:
-    #         if _type == np.int64:
-    #             return np.int64(np.random.rand(dim[0]))
-    #         if _type == np.float32:
-    #             return np.float32(np.random.rand(dim[0]))
-    #     if len(dim) == 2:
-    #         if _type == np.int64:
-    #             return np.int64(np.random.rand(dim[0], dim[1]))
-    #         if _type == np.float32:
-    #             return np.float32(np.random.rand(dim[0], dim[1]))
-    #     if len(dim) == 3:
-    #         if _type == np.int64:
-    #             return np.int64(np.random.rand(dim[0], dim[1], dim[2]))
-    #         if _type == np.float32:
-    #             return np.float32(np.random.rand(dim[0], dim[1], dim[2]))
-    #     if len(dim) == 4:
-    #         if _type == np.int64:
-    #             return np.int64(np.random.rand(dim[0], dim[1], dim[2], dim[3]))
-    #         if _type == np.float32:
-    #             return np.float32(np.random.rand(dim[0], dim[1], dim[2], dim[3]))
-
-    def generate_weights(self, seed, dim, _type):
-        torch.manual_seed(seed)
-        if len(dim) == 0:
-            return torch.tensor(0)
-        elif len(dim) == 1:
-            if _type == torch.int64:
-                return torch.randn(dim[0])
-            elif _type == torch.float32:
-                return torch.randn(dim[0], dtype=torch.float32)
-        elif len(dim) == 2:
-            if _type == torch.int64:
-                return torch.randn((dim[0], dim[1]))
-            elif _type == torch.float32:
-                return torch.randn((dim[0], dim[1]), dtype=torch.float32)
-        elif len(dim) == 3:
-            if _type == torch.int64:
-                return torch.randn((dim[0], dim[1], dim[2]))
-            elif _type == torch.float32:
-                return torch.randn((dim[0], dim[1], dim[2]), dtype=torch.float32)
-        elif len(dim) == 4:
-            if _type == torch.int64:
-                return torch.randn((dim[0], dim[1], dim[2], dim[3]))
-            elif _type == torch.float32:
-                return torch.randn((dim[0], dim[1], dim[2], dim[3]), dtype=torch.float32)
-
-    # 服务器如果没有收到某个客户端的梯度，就会自己生成掩码去unmask
-    def reveal(self, keylist):
-        wghts = np.zeros(self.dim)
+                parts[int(_id)] = item[_id]
+            if len(parts) < t:
+                raise ValueError("client {} has only {} of {} shares".format(client_id, len(parts), t))
+            id_list = tuple(sorted(parts)[:t])
+            if id_list not in groups:
+                groups[id_list] = ([], [])
+            groups[id_list][0].append(client_id)
+            groups[id_list][1].append([parts[_id] for _id in id_list])
+        secretkey_bu = {}
+        for id_list, (client_ids, shares) in groups.items():
+            # (客户端数, t, 2, limb数)，single时为(客户端数, t, limb数)
+            shares = np.asarray(shares, dtype=np.int64)
+            if single:
+                # -> (t, 客户端数, limb数)
+                secrets = reconstruct_secrets(shares.transpose(1, 0, 2), id_list)
+                for i, client_id in enumerate(client_ids):
+                    secretkey_bu[client_id] = secrets[i]
+                continue
+            # -> (t, 客户端数 * 2, limb数)
+            shares = shares.transpose(1, 0, 2, 3).reshape(t, len(client_ids) * 2, -1)
+            secrets = reconstruct_secrets(shares, id_list)
+            for i, client_id in enumerate(client_ids):
+                secretkey_bu[client_id] = secrets[2 * i:2 * i + 2]
+        return secretkey_bu
+
+    # 服务器如果没有收到某个客户端的梯度，就会用重构的私钥重新生成它与邻居之间的掩码去unmask
+    # keylist: {邻居id: 邻居公钥}，返回该客户端本应加上的[(seed, +1/-1), ...]
+    def reveal(self, client_id, secretkey, keylist):
+        if client_id not in self.recovered_keys:
+            base, mod, exponent_bits = get_group(self.conf["key_group"])
+            self.recovered_keys[client_id] = KeyAgreement(base, mod, secretkey=secretkey)
+        key_agreement = self.recovered_keys[client_id]
+        signed_seeds = []
         for each in keylist:
-            if each < self.id:
-                wghts -= self.generate_weights((self.keys[each] ** self.secretkey) % 17)
-            elif each > self.id:
-                wghts += self.generate_weights((self.keys[each] ** self.secretkey) % 17)
-        return -1 * wghts
-
-    def unmask(self):
-        for client_id in self.all_part_secretkey_bu:
-            # 重构key bu
-            secretkey_bu = self.reconstruct_secretkey_bu(self.conf["t"], self.all_part_secretkey_bu[client_id])
+            seed = key_agreement.shared_seed(each, keylist[each])
+            if each < client_id:
+                signed_seeds.append((seed, -1))
+            elif each > client_id:
+                signed_seeds.append((seed, 1))
+        return signed_seeds
+
+    # 拓扑图中与client_id相连的客户端
+    def neighbors(self, client_id):
+        neighbors = []
+        for client1, client2, cost in self.part_connect_graph:
+            if client1 == client_id:
+                neighbors.append(client2)
+            if client2 == client_id:
+                neighbors.append(client1)
+        return neighbors
+
+    # 各客户端收集到的份额，一份都没有收到的客户端同样无法重建
+    def _parts(self, client_ids):
+        parts = {}
+        for client_id in client_ids:
+            parts[client_id] = self.all_part_secretkey_bu.get(client_id, [])
+        return parts
+
+    # survivors: 本轮成功上传更新的客户端id，None表示没有客户端掉线
+    # 份额不足t个、无法重建时撤销本轮的更新并抛出ValueError
+    # 在线的客户端只消除bu掩码；掉线的客户端重构私钥，只重新生成它与在线邻居之间的两两掩码，
+    # 代价与掉线客户端的度数成正比，与客户端总数无关
+    def unmask(self, survivors=None):
+        fixed_point = self.mask_engine.fixed_point
+        if survivors is None:
+            survivors = list(self.all_part_secretkey_bu.keys())
+        survivors = set(survivors)
+        dropped = [c.client_id for c in self.client_list if c.client_id not in survivors]
+        # 在线的客户端只重构bu，掉线的客户端只重构私钥（只有与在线客户端相连时才需要）；
+        # 客户端按同一个survivors只上传对应的一种份额（Client.unmask_shares），服务器得不到同一个客户端的私钥和bu
+        keylists = {}
+        for client_id in dropped:
+            keylist = {}
+            for each in self.neighbors(client_id):
+                if each in survivors:
+                    keylist[each] = self.client_pubkey[each]
+            if keylist:
+                keylists[client_id] = keylist
+        try:
+            all_bu = self.reconstruct_all_secretkey_bu(self.conf["t"], self._parts(survivors), True)
+            all_secretkey = self.reconstruct_all_secretkey_bu(self.conf["t"], self._parts(keylists), True)
+        except ValueError:
+            # 无法消除掩码：撤销本轮已经加上的（带掩码的）更新后再抛出
+            self.revert_aggregate()
+            raise
+        # 需要从和中去掉的所有掩码
+        signed_seeds = []
+        for client_id in survivors:
             # 消除bu掩码
-            for name, data in self.global_model.state_dict().items():
-                _data = data
-                dim = _data.shape
-                _type = _data.dtype
-                bu_mask = -self.conf["lambda"] * self.generate_weights(secretkey_bu[1], dim, _type)
-                if data.type() != bu_mask.type():
-                    data.add_(bu_mask.to(torch.int64))
-                else:
-                    data.add_(bu_mask)
+            signed_seeds.append((all_bu[client_id], -1))
+        for client_id, keylist in keylists.items():
+            # 在线邻居加上的两两掩码没有被抵消，补上掉线客户端本应加的掩码
+            signed_seeds.extend(self.reveal(client_id, all_secretkey[client_id], keylist))
+        if self.sharded_aggregator is not None:
+            # 各分片进程并行地在自己的分片上消除掩码
+            step_ranges = None if fixed_point is None else fixed_point.step_ranges()
+            update = self.sharded_aggregator.unmask(signed_seeds, self.conf["lambda"], step_ranges)
+            self.add_to_model(update)
+            return
+        # 按块流式生成所有修正掩码之和，逐块更新模型的扁平向量
+        for start, end, correction in self.mask_engine.stream(signed_seeds, self.conf["mask_chunk"]):
+            block = self.global_flat[start:end]
+            if fixed_point is not None:
+                # 整数环上精确消除，所有掩码消除后这一块只解码一次
+                ring_sum = self.ring_sum[start:end]
+                correction = fixed_point.decode(fixed_point.wrap_(ring_sum.add_(correction.to(ring_sum.device))), start)
+            block.add_(correction.to(block.device), alpha=self.conf["lambda"])
+
+    # 不加掩码、直接上传浮点更新的驱动（main.py、socket、zmq）只能用float模式：
+    # ring/量化模式下聚合器是int64累加器，收不了浮点更新，启动时就报错
+    def require_float_mode(self):
+        if self.mask_engine.fixed_point is not None:
+            raise ValueError("agg_mode \"{}\" with quant_bits {} needs masked uploads; "
+                             "this driver only supports agg_mode \"float\" with quant_bits 0"
+                             .format(self.conf["agg_mode"], self.conf["quant_bits"]))
+
+    def store_pubkey(self, pubkey):
+        client_id = list(pubkey.keys())[0]
+        self.client_pubkey[client_id] = pubkey[client_id]
+
+    # 新一轮的流式聚合器，expected为本轮预计上传的客户端数量
+    # agg_shards大于0时使用按参数分片的多进程聚合器，之后的聚合和unmask都交给各分片进程
+    def new_aggregator(self, expected=0):
+        if self.conf["agg_shards"] > 0:
+            self.sharded_aggregator = ShardedAggregator(self.mask_engine.layout, self.global_model.state_dict(),
+                                                        self.mask_engine.fixed_point, expected, self.conf)
+            return self.sharded_aggregator
+        return StreamingAggregator(self.mask_engine.layout, self.global_model.state_dict(),
+                                   self.mask_engine.fixed_point, expected, self.conf["mmap_dir"])
+
+    # global_flat += alpha * update，按块进行，内存映射存储时每次只需换入一块
+    def add_to_model(self, update, alpha=1):
+        for start, end in chunk_ranges(self.mask_engine.layout.numel, self.conf["mask_chunk"]):
+            block = self.global_flat[start:end]
+            block.add_(update[start:end].to(block.device), alpha=alpha)
 
     # 模型聚合函数agg
-    # weight_accumulator 存储了每一个客户端的上传参数变化值/差值
-    def model_aggregate(self, weight_accumulator):
-        # 遍历服务器的全局模型
-        for name, data in self.global_model.state_dict().items():
+    # aggregator 流式累加了每一个客户端的上传参数变化值/差值
+    def model_aggregate(self, aggregator):
+        # 本轮作废时用于撤销
+        self.last_aggregator = aggregator
+        if self.mask_engine.fixed_point is not None:
+            # ring模式：先收下整数环上的和，等unmask消除bu掩码后再解码更新（分片模式下和留在各分片进程中）
+            if aggregator is not self.sharded_aggregator:
+                self.ring_sum = aggregator.flat
+        elif aggregator is self.sharded_aggregator:
+            # 各分片进程并行算出更新量，再一次加回全局模型
+            self.add_to_model(aggregator.aggregate(self.conf["lambda"]))
+        else:
+            # 所有浮点层融合的缩放加法，没有逐层的临时张量
+            self.add_to_model(aggregator.flat, alpha=self.conf["lambda"])
+        self.add_others(aggregator, self.conf["lambda"])
+
+    # 撤销model_aggregate已经加到全局模型上的更新（unmask失败、本轮作废时），全局模型回到本轮开始时的状态
+    def revert_aggregate(self):
+        aggregator = self.last_aggregator
+        if self.mask_engine.fixed_point is None:
+            if aggregator is self.sharded_aggregator:
+                # 各分片进程算出的更新量仍在共享内存中
+                self.add_to_model(aggregator.update, alpha=-1)
+            else:
+                self.add_to_model(aggregator.flat, alpha=-self.conf["lambda"])
+        self.ring_sum = None
+        self.add_others(aggregator, -self.conf["lambda"])
+
+    # 不在扁平布局中的整数缓冲区（如num_batches_tracked），以及低比特量化时不量化的浮点缓冲区
+    def add_others(self, aggregator, alpha):
+        state_dict = self.global_model.state_dict()
+        for name, params in aggregator.others.items():
+            data = state_dict[name]
             # 更新每一层乘上学习率
-            update_per_layer = weight_accumulator[name] * self.conf["lambda"]
+            update_per_layer = params * alpha
             # 累加和
             if data.type() != update_per_layer.type():
                 # 因为update_per_layer的type是floatTensor，所以将起转换为模型的LongTensor（有一定的精度损失）
@@ -1,19 +1,19 @@
 import argparse
 import json
+import random
 import time
 
-import torch
-
 import socket
 import threading
 import ctypes
 import inspect
 
 import datasets
-from client import Client
+from client import ClientRegistry, share_all_secretkey_bu
 from client_ccesa import DeviceServerSocket
-from graph import GraphStruct
+from graph import GraphStruct, aggregation_tree
 from server import Server
+from simulate import make_trainer, train_clients
 
 global collect_nums
 collect_nums = 0
@@ -73,10 +73,10 @@ def finish_step3(candidates):
         time.sleep(1)
 
 
-def finish_step4():
+def finish_step4(n):
     global collect_nums
     while True:
-        if collect_nums == conf["k"]:
+        if collect_nums == n:
             collect_nums = 0
             break
         time.sleep(1)
@@ -138,6 +138,7 @@ class NodeServerRecv(threading.Thread):
         self.client_socket = _client_socket
         self.server = _server
         self.signal = 0
+        self.buffer = b''
 
     def run(self):
         global collect_nums
@@ -153,15 +154,19 @@ class NodeServerRecv(threading.Thread):
             elif _data == b'part_secretkey_bu':
                 self.signal = 3
             else:
+                # 大整数的公钥和份额可能超过一次recv的长度，拼接成完整的json再处理
+                self.buffer += _data
+                try:
+                    data = json.loads(self.buffer)
+                except ValueError:
+                    continue
+                self.buffer = b''
                 if self.signal == 1:
-                    data = json.loads(_data)
                     self.server.collect_shared_secretkey_bu(data)
                     collect_nums += 1
                 elif self.signal == 2:
-                    data = json.loads(_data)
                     transmit_pubkey_to_client(self.server, data)
                 elif self.signal == 3:
-                    data = json.loads(_data)
                     transmit_part_secretkey_bu_to_client(self.server, data)
                 else:
                     pass
@@ -211,7 +216,7 @@ if __name__ == '__main__':
     parser.add_argument('--port', type=int, default=8080)
     args = parser.parse_args()
 
-    train_datasets, eval_datasets = datasets.get_dataset("data/", conf["type"])
+    train_datasets, eval_datasets = datasets.get_dataset("data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
 
     # 启动服务器
     server = Server(conf, eval_datasets)
@@ -225,12 +230,19 @@ if __name__ == '__main__':
         device_server.start()
         device_servers.append(device_server)
 
+    # 流式聚合器在各轮之间复用
+    aggregator = server.new_aggregator()
+    # 客户端只创建一次，每轮只刷新本轮的密钥和状态
+    registry = ClientRegistry(conf, server.global_model, train_datasets)
+    # 本地训练的模拟方式：进程池并行、vmap向量化批量训练，或逐个训练（trainer为None）
+    trainer = make_trainer(server.global_model, train_datasets, conf)
+
     for e in range(conf["global_epochs"]):
         print("Global Epoch %d" % e)
 
         candidates = []
         for i in range(conf["k"]):
-            c = Client(conf, server.global_model, train_datasets, str(i + 1))
+            c = registry.get(str(i + 1))
             candidates.append(c)
             device_servers[i].set_client(c)
         candidates_dict = {}
@@ -263,15 +275,23 @@ if __name__ == '__main__':
                         conf["device" + c.client_id + "_port"],
                         "advertise pubkey", [])
         finish_step2(candidates)
+        for c in candidates:
+            server.store_pubkey({c.client_id: c.sec_agg.pubkey})
+            # 公钥齐全后在后台预计算掩码，与本地训练并行
+            c.precompute_mask()
         print("完成广播公钥...")
 
         # 共享密钥和bu
         print("开始共享密钥和bu...")
-        for c in candidates:
-            server_send(conf["device" + c.client_id + "_ip"],
-                        conf["device" + c.client_id + "_port"],
-                        "shared key", [])
-        finish_step3(candidates)
+        if conf["batch_share"]:
+            # 各设备都在本进程中模拟，所有客户端的私钥和bu在一次向量化计算中分享
+            share_all_secretkey_bu(candidates, conf["t"], server.neighbors)
+        else:
+            for c in candidates:
+                server_send(conf["device" + c.client_id + "_ip"],
+                            conf["device" + c.client_id + "_port"],
+                            "shared key", [])
+            finish_step3(candidates)
         print("完成共享密钥和bu...")
 
         # for c in candidates:
@@ -287,25 +307,47 @@ if __name__ == '__main__':
         #     print(client_id, secretkey_bu[0], secretkey_bu[1])
 
         print("开始联邦学习...")
-        weight_accumulator = {}
-        for name, params in server.global_model.state_dict().items():
-            weight_accumulator[name] = torch.zeros_like(params)
+        survivors = []
         for c in candidates:
-            diff = c.local_train(server.global_model)
+            # 模拟客户端掉线：掉线的客户端不上传更新，由服务器在unmask时补偿它的两两掩码
+            if random.random() < conf["drop_rate"]:
+                print("客户端{}掉线...".format(c.client_id))
+                continue
+            survivors.append(c.client_id)
+        if conf["tree_agg"]:
+            # 树聚合：沿拓扑图的生成树，子节点先训练，父节点把子节点的部分和加到自己的更新上再转发，
+            # 服务器只收到各个根节点的部分和
+            parent, order = aggregation_tree(server.part_connect_graph, survivors)
+        else:
+            parent, order = dict.fromkeys(survivors), survivors
+        # 每个更新到达就立即累加，累加后释放
+        aggregator.reset(list(parent.values()).count(None))
+        # 等待父节点的部分和
+        partial_sums = {}
+        for c, diff in train_clients([candidates_dict[i] for i in order], server.global_model, trainer):
             c.mask(diff)
-            for name, params in server.global_model.state_dict().items():
-                weight_accumulator[name].add_(diff[name])
+            for partial in partial_sums.pop(c.client_id, []):
+                c.add_partial(diff, partial)
+            if parent[c.client_id] is None:
+                aggregator.add(diff)
+            else:
+                partial_sums.setdefault(parent[c.client_id], []).append(diff)
+            del diff
 
-        server.model_aggregate(weight_accumulator)
+        server.model_aggregate(aggregator)
 
-        # 消除掩码
-        for c in candidates:
-            server_send(conf["device" + c.client_id + "_ip"],
-                        conf["device" + c.client_id + "_port"],
-                        "unmask", [])
-        finish_step4()
+        # 消除掩码：把在线客户端列表发给各在线客户端，它们据此只上传需要的那种份额
+        for client_id in survivors:
+            server_send(conf["device" + client_id + "_ip"],
+                        conf["device" + client_id + "_port"],
+                        "unmask", survivors)
+        finish_step4(len(survivors))
 
-        server.unmask()
+        try:
+            server.unmask(survivors)
+        except ValueError as e:
+            # 份额不足，无法消除掩码：本轮作废，全局模型保持不变
+            print("本轮作废：{}".format(e))
 
         acc, loss = server.model_eval()
         print("Global Epoch %d, acc: %f, loss: %f\n" % (e, acc, loss))
@@ -313,6 +355,8 @@ if __name__ == '__main__':
         # clean server
         server.part_connect_graph = []
         server.all_part_secretkey_bu = {}
+        server.recovered_keys = {}
+        server.client_pubkey = {}
         server.client_dict = {}
         server.client_list = []
 
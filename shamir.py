@@ -0,0 +1,101 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+
+# t-out-of-n秘密分享所在的素数域：p = 2^31 - 1，两个域元素的乘积不超过int64
+FIELD_PRIME = 2 ** 31 - 1
+# 大整数秘密按30位切分成多个limb，每个limb都是一个域元素，分别分享
+LIMB_BITS = 30
+
+
+# 秘密位数 -> limb个数
+def limb_count(bits):
+    return max(1, (bits + LIMB_BITS - 1) // LIMB_BITS)
+
+
+# limb内各位的权重
+_LIMB_WEIGHTS = np.left_shift(1, np.arange(LIMB_BITS, dtype=np.int64))
+
+
+# 整数秘密列表 -> (秘密数, limb数)的int64数组，低位在前
+# 每个秘密只转换一次成小端字节串，拆位和按30位重组都在numpy中整体进行
+def to_limbs(secrets, n_limbs):
+    n_bytes = (n_limbs * LIMB_BITS + 7) // 8
+    data = np.frombuffer(b"".join(secret.to_bytes(n_bytes, 'little') for secret in secrets), dtype=np.uint8)
+    bits = np.unpackbits(data.reshape(len(secrets), n_bytes), axis=1, bitorder='little')
+    # 秘密不能超过n_limbs个limb
+    assert not bits[:, n_limbs * LIMB_BITS:].any()
+    bits = bits[:, :n_limbs * LIMB_BITS].reshape(len(secrets), n_limbs, LIMB_BITS).astype(np.int64)
+    return bits @ _LIMB_WEIGHTS
+
+
+# (秘密数, limb数)的数组 -> 整数秘密列表
+def from_limbs(limbs):
+    limbs = np.asarray(limbs, dtype=np.int64)
+    bits = ((limbs[..., None] >> np.arange(LIMB_BITS)) & 1).astype(np.uint8).reshape(len(limbs), -1)
+    data = np.packbits(bits, axis=1, bitorder='little')
+    return [int.from_bytes(row.tobytes(), 'little') for row in data]
+
+
+# 一次性分享多个秘密给所有持有者：每个秘密的每个limb取一个t-1次随机多项式f，f(0)=limb，
+# 持有者x得到f(x) mod p；用Horner法则在 持有者 x 秘密 x limb 上整体向量化求值
+# 返回(持有者数, 秘密数, limb数)的int64数组
+def share_secrets(secrets, t, xs, n_limbs):
+    limbs = to_limbs(secrets, n_limbs)
+    x = np.asarray(xs, dtype=np.int64).reshape(-1, 1, 1) % FIELD_PRIME
+    # 在0点求值得到的份额就是秘密本身
+    if not x.all():
+        raise ValueError("holder ids must be non-zero mod {}".format(FIELD_PRIME))
+    # 多项式的1..t-1次系数，取自操作系统的密码学安全随机数（64位取模p，偏差可以忽略）
+    shape = (t - 1,) + limbs.shape
+    coeffs = (np.frombuffer(os.urandom(8 * int(np.prod(shape))), dtype='<u8') % FIELD_PRIME).astype(np.int64)
+    coeffs = coeffs.reshape(shape)
+    shares = np.zeros((len(xs),) + limbs.shape, dtype=np.int64)
+    for j in range(t - 2, -1, -1):
+        shares += coeffs[j]
+        shares *= x
+        shares %= FIELD_PRIME
+    shares += limbs
+    shares %= FIELD_PRIME
+    return shares
+
+
+# 向量化的模幂 base^exponent mod p
+def _pow_mod(base, exponent):
+    result = np.ones_like(base)
+    base = base % FIELD_PRIME
+    while exponent:
+        if exponent & 1:
+            result = result * base % FIELD_PRIME
+        base = base * base % FIELD_PRIME
+        exponent >>= 1
+    return result
+
+
+# 拉格朗日插值在0点的系数：l_i(0) = prod_{j != i} x_j / (x_j - x_i) mod p
+# 同一组持有者的系数只计算一次，之后直接复用
+@lru_cache(maxsize=128)
+def lagrange_coefficients(xs):
+    x = np.asarray(xs, dtype=np.int64) % FIELD_PRIME
+    eye = np.eye(len(x), dtype=bool)
+    # 对角线置1，行内连乘即为j != i的乘积
+    nums = np.where(eye, 1, x[None, :])
+    dens = np.where(eye, 1, (x[None, :] - x[:, None]) % FIELD_PRIME)
+    num = np.ones(len(x), dtype=np.int64)
+    den = np.ones(len(x), dtype=np.int64)
+    for j in range(len(x)):
+        num = num * nums[:, j] % FIELD_PRIME
+        den = den * dens[:, j] % FIELD_PRIME
+    # 费马小定理求逆元
+    coefficients = num * _pow_mod(den, FIELD_PRIME - 2) % FIELD_PRIME
+    coefficients.setflags(write=False)
+    return coefficients
+
+
+# 由t个持有者的份额(t, 秘密数, limb数)恢复秘密列表，秘密数可以包含许多客户端的秘密
+def reconstruct_secrets(shares, xs):
+    coefficients = lagrange_coefficients(tuple(int(x) for x in xs)).reshape(-1, 1, 1)
+    shares = np.asarray(shares, dtype=np.int64)
+    limbs = (shares * coefficients % FIELD_PRIME).sum(axis=0) % FIELD_PRIME
+    return from_limbs(limbs)
@@ -0,0 +1,69 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from prg import chunk_ranges, expand_sum
+
+# 分片聚合进程执行的命令
+ADD = "add"
+RESET = "reset"
+AGGREGATE = "aggregate"
+UNMASK = "unmask"
+STOP = "stop"
+
+
+# 整数环上的元素按补码解释为有符号数，再除以2^frac_bits（与FixedPoint.decode一致）；
+# step_ranges不为None时（低比特量化）按各层的步长缩放，start为q在扁平向量中的起始位置
+def decode(q, bits, frac_bits, step_ranges=None, start=0):
+    values = (q - ((q >> (bits - 1)) << bits)).astype(np.float64)
+    if step_ranges is None:
+        values /= float(1 << frac_bits)
+    else:
+        end = start + len(q)
+        for lo, hi, step in step_ranges:
+            lo, hi = max(lo, start), min(hi, end)
+            if lo < hi:
+                values[lo - start:hi - start] *= step
+    return values.astype(np.float32)
+
+
+# 分片聚合进程：只负责扁平参数向量中[start, end)这一片，
+# 私有地累加每个上传在这一片上的部分，并在这一片上消除掩码；结果（模型的更新量）写进共享内存
+# 只依赖numpy，用spawn启动时不需要导入torch
+def shard_worker(shm_name, numel, start, end, commands, results, backend, chunk_size, bits, frac_bits):
+    shm = SharedMemory(name=shm_name)
+    out = np.ndarray((numel,), dtype=np.float32, buffer=shm.buf)[start:end]
+    acc = np.zeros(end - start, dtype=np.float32 if bits is None else np.int64)
+    correction = np.empty(min(chunk_size, end - start), dtype=acc.dtype)
+    while True:
+        command = commands.get()
+        if command[0] == ADD:
+            offset, values = command[1], command[2]
+            block = acc[offset:offset + len(values)]
+            block += values
+            if bits is not None:
+                block &= (1 << bits) - 1
+        elif command[0] == RESET:
+            acc[:] = 0
+        elif command[0] == AGGREGATE:
+            # 浮点模式：更新量为alpha * 和
+            np.multiply(acc, command[1], out=out)
+            results.put(start)
+        elif command[0] == UNMASK:
+            signed_seeds, alpha, step_ranges = command[1], command[2], command[3]
+            for lo, hi in chunk_ranges(end - start, chunk_size):
+                block = correction[:hi - lo]
+                expand_sum(backend, signed_seeds, block, start + lo, chunk_size, bits)
+                if bits is None:
+                    np.multiply(block, alpha, out=out[lo:hi])
+                else:
+                    # 整数环上精确消除，这一块只解码一次
+                    ring_sum = acc[lo:hi]
+                    ring_sum += block
+                    ring_sum &= (1 << bits) - 1
+                    np.multiply(decode(ring_sum, bits, frac_bits, step_ranges, start + lo), alpha, out=out[lo:hi])
+            results.put(start)
+        elif command[0] == STOP:
+            break
+    del out
+    shm.close()
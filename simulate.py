@@ -0,0 +1,244 @@
+import math
+import multiprocessing
+import weakref
+from copy import deepcopy
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import torch
+from torch.func import functional_call, grad, vmap
+
+import datasets
+from mask import FlatLayout
+
+# 训练进程执行的命令
+TRAIN = "train"
+STOP = "stop"
+
+
+# 训练进程：全局模型的浮点参数直接映射共享内存中每轮发布的扁平向量（只读），
+# 本进程内按需创建各客户端（数据划分与主进程相同），训练得到的更新量写进主进程指定的槽位
+def train_worker(model, train_dataset, conf, global_name, diff_name, n_slots, tasks, results):
+    from client import Client
+    # 每个进程占一个核，避免多个进程的线程争抢
+    torch.set_num_threads(1)
+    layout = FlatLayout(model.state_dict())
+    global_shm = SharedMemory(name=global_name)
+    diff_shm = SharedMemory(name=diff_name)
+    global_flat = torch.from_numpy(np.ndarray((layout.numel,), dtype=np.float32, buffer=global_shm.buf))
+    diffs = torch.from_numpy(np.ndarray((n_slots, layout.numel), dtype=np.float32, buffer=diff_shm.buf))
+    global_model = model
+    layout.bind(global_model, global_flat, load=False)
+    # 各客户端共用一个本地模型，local_train开始时会用全局模型覆盖它
+    local_model = deepcopy(model)
+    clients = {}
+    results.put(None)
+    while True:
+        command = tasks.get()
+        if command[0] == STOP:
+            break
+        client_id, slot, others = command[1], command[2], command[3]
+        state_dict = global_model.state_dict()
+        for name, data in others.items():
+            state_dict[name].copy_(data)
+        if client_id not in clients:
+            clients[client_id] = Client(conf, local_model, train_dataset, client_id)
+        diff = clients[client_id].local_train(global_model)
+        layout.flatten(diff, diffs[slot])
+        other_diffs = {}
+        for name in diff:
+            if name not in layout.names:
+                other_diffs[name] = diff[name]
+        del diff
+        results.put((client_id, slot, other_diffs))
+    del global_flat, diffs
+    global_shm.close()
+    diff_shm.close()
+
+
+# 并行模拟各客户端的本地训练：每轮把全局模型发布到共享内存一次，各训练进程只读映射，不需要pickle模型；
+# 更新量通过预先分配的共享槽位传回，槽位在调用方处理完该更新后复用，内存与客户端数量无关
+class ParallelTrainer(object):
+    def __init__(self, model, train_dataset, conf):
+        self.conf = conf
+        self.layout = FlatLayout(model.state_dict())
+        processes = conf["train_processes"]
+        # 每个进程两个槽位：调用方处理一个更新时，进程可以继续训练下一个
+        self.n_slots = 2 * processes
+        numel = self.layout.numel
+        self.global_shm = SharedMemory(create=True, size=max(numel * 4, 1))
+        self.diff_shm = SharedMemory(create=True, size=max(self.n_slots * numel * 4, 1))
+        self.global_flat = torch.from_numpy(np.ndarray((numel,), dtype=np.float32, buffer=self.global_shm.buf))
+        self.diffs = torch.from_numpy(np.ndarray((self.n_slots, numel), dtype=np.float32, buffer=self.diff_shm.buf))
+        self.free_slots = list(range(self.n_slots))
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = []
+        for _ in range(processes):
+            process = context.Process(target=train_worker, daemon=True,
+                                      args=(deepcopy(model), train_dataset, conf, self.global_shm.name,
+                                            self.diff_shm.name, self.n_slots, self.tasks, self.results))
+            process.start()
+            self.workers.append(process)
+        # 等所有进程映射好全局模型后才能发布
+        for _ in self.workers:
+            self.results.get()
+        # 本轮全局模型的整数缓冲区（很小，随任务发送）
+        self.others = {}
+        weakref.finalize(self, _stop_workers, self.workers, self.tasks, self.global_shm, self.diff_shm)
+
+    # 发布本轮的全局模型：一次拷贝进共享内存
+    def publish(self, global_model):
+        state_dict = global_model.state_dict()
+        self.layout.flatten(state_dict, self.global_flat)
+        self.others = {}
+        for name, data in state_dict.items():
+            if name not in self.layout.names:
+                self.others[name] = data.clone()
+
+    # 并行训练clients，按clients的顺序依次返回(客户端, 更新量)
+    # 更新量的浮点层是共享槽位的视图，调用方取下一个之前必须处理完（累加或加掩码）
+    def train(self, clients, global_model):
+        self.publish(global_model)
+        dispatched = 0
+        done = {}
+        for c in clients:
+            while dispatched < len(clients) and self.free_slots:
+                self.tasks.put((TRAIN, clients[dispatched].client_id, self.free_slots.pop(), self.others))
+                dispatched += 1
+            while c.client_id not in done:
+                client_id, slot, other_diffs = self.results.get()
+                done[client_id] = (slot, other_diffs)
+            slot, other_diffs = done.pop(c.client_id)
+            diff = self.layout.unflatten(self.diffs[slot], {})
+            diff.update(other_diffs)
+            try:
+                yield c, diff
+            finally:
+                del diff
+                self.free_slots.append(slot)
+
+
+# 把一组模拟客户端的参数堆叠起来，用torch.func的vmap在一次向量化的前向/反向传播中同时训练；
+# 每个客户端使用自己的数据划分（与Client.train_loader相同）和自己的动量缓冲区，
+# BatchNorm的运行统计量同样按客户端堆叠、各自更新，结果与逐个调用local_train一致
+class BatchedTrainer(object):
+    def __init__(self, model, conf):
+        self.conf = conf
+        # 只提供模型结构，参数和缓冲区每次调用时传入
+        self.model = deepcopy(model)
+        self.model.train()
+        self.group_size = conf["vmap_clients"]
+        self.param_names = [name for name, _ in self.model.named_parameters()]
+        self.buffer_names = [name for name, _ in self.model.named_buffers()]
+        self.device = next(self.model.parameters()).device
+        # 对每个客户端分别求梯度，缓冲区（BatchNorm统计量）在前向中原地更新
+        self.grad = vmap(grad(self._loss))
+
+    def _loss(self, params, buffers, data, target):
+        output = functional_call(self.model, (params, buffers), (data,))
+        return torch.nn.functional.cross_entropy(output, target)
+
+    # 按clients的顺序依次返回(客户端, 更新量)，每group_size个客户端一起训练
+    def train(self, clients, global_model):
+        for start in range(0, len(clients), self.group_size):
+            group = clients[start:start + self.group_size]
+            stacked = self._train_group(group, global_model)
+            state_dict = global_model.state_dict()
+            for i, c in enumerate(group):
+                diff = {}
+                for name, data in state_dict.items():
+                    # 计算训练后与训练前的差值
+                    diff[name] = stacked[name][i] - data
+                yield c, diff
+            del stacked
+
+    def _train_group(self, group, global_model):
+        state_dict = global_model.state_dict()
+        n = len(group)
+        params = {}
+        buffers = {}
+        for name in self.param_names:
+            params[name] = state_dict[name].detach().unsqueeze(0).repeat(n, *[1] * state_dict[name].dim())
+        for name in self.buffer_names:
+            buffers[name] = state_dict[name].detach().unsqueeze(0).repeat(n, *[1] * state_dict[name].dim())
+        # 各客户端的动量缓冲区，从0开始时第一步即为梯度本身（与torch.optim.SGD一致）
+        momentum = {}
+        for name, data in params.items():
+            momentum[name] = torch.zeros_like(data)
+        indices = [torch.as_tensor(c.train_indices, dtype=torch.long) for c in group]
+        batch_size = self.conf["batch_size"]
+        for e in range(self.conf["local_epochs"]):
+            orders = [idx[torch.randperm(len(idx))] for idx in indices]
+            n_steps = max(math.ceil(len(order) / batch_size) for order in orders)
+            for step in range(n_steps):
+                batches = [order[step * batch_size:(step + 1) * batch_size] for order in orders]
+                # 本步批大小相同的客户端一起训练（通常只有每轮最后一批不满），数据用完的客户端不再更新
+                sizes = {}
+                for i, batch in enumerate(batches):
+                    if len(batch) > 0:
+                        sizes.setdefault(len(batch), []).append(i)
+                for members in sizes.values():
+                    self._step(group, members, batches, params, buffers, momentum)
+            for c in group:
+                print("Client {} Epoch {} done.".format(c.client_id, e))
+        params.update(buffers)
+        return params
+
+    # members中的客户端各自在自己的一批数据上做一步带动量的SGD
+    def _step(self, group, members, batches, params, buffers, momentum):
+        data = []
+        target = []
+        for i in members:
+            batch_data, batch_target = datasets.gather(group[i].train_dataset, batches[i])
+            data.append(batch_data)
+            target.append(batch_target)
+        data = torch.stack(data).to(self.device)
+        target = torch.stack(target).to(self.device)
+        subset = len(members) < len(group)
+        if subset:
+            index = torch.as_tensor(members, device=self.device)
+            p, b, m = [{name: value[index] for name, value in d.items()} for d in (params, buffers, momentum)]
+        else:
+            p, b, m = params, buffers, momentum
+        grads = self.grad(p, b, data, target)
+        for name in p:
+            m[name].mul_(self.conf['momentum']).add_(grads[name])
+            p[name].sub_(self.conf['lr'] * m[name])
+        if subset:
+            for full, part in ((params, p), (buffers, b), (momentum, m)):
+                for name in part:
+                    full[name][index] = part[name]
+
+
+# 按配置创建本地训练的模拟引擎：train_processes大于0时进程池并行，vmap_clients大于0时向量化批量训练，
+# 都为0时返回None，在本进程中逐个训练
+def make_trainer(model, train_dataset, conf):
+    if conf["train_processes"] > 0:
+        return ParallelTrainer(model, train_dataset, conf)
+    if conf["vmap_clients"] > 0:
+        return BatchedTrainer(model, conf)
+    return None
+
+
+# 依次返回各客户端的(客户端, 更新量)：trainer为None时在本进程中顺序训练
+def train_clients(clients, global_model, trainer=None):
+    if trainer is None:
+        for c in clients:
+            yield c, c.local_train(global_model)
+    else:
+        yield from trainer.train(clients, global_model)
+
+
+def _stop_workers(workers, tasks, global_shm, diff_shm):
+    for _ in workers:
+        tasks.put((STOP,))
+    for process in workers:
+        process.join()
+    for shm in (global_shm, diff_shm):
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        shm.unlink()
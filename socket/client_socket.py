@@ -1,10 +1,13 @@
 import argparse
+import copy
 import json
 import socket
+import struct
 import threading
 
 import datasets
 import models
+from broadcast import ModelReceiver
 from client import Client
 
 
@@ -14,6 +17,9 @@ class ClientSocket(threading.Thread):
         self.ip = _ip
         self.port = _port
         self.client = _client
+        # 服务器下发的全局模型（完整快照或增量）保存在单独的副本中，本地训练从它开始并与它求差值
+        self.global_model = copy.deepcopy(self.client.local_model)
+        self.receiver = ModelReceiver(self.global_model)
         self.init()
 
 
@@ -32,14 +38,29 @@ class ClientSocket(threading.Thread):
         data = _data.decode()
         return data
 
+    # 接收b'model' + 8字节长度 + 消息，应用到全局模型副本上，返回消息之后多收到的数据
+    def recv_param(self, _data):
+        while len(_data) < 13:
+            _data += self.socket.recv(1024)
+        length = struct.unpack('>Q', _data[5:13])[0]
+        while len(_data) < 13 + length:
+            _data += self.socket.recv(max(1024, 13 + length - len(_data)))
+        self.receiver.apply(_data[13:13 + length])
+        return _data[13 + length:]
+
     def run(self):
         while (1):
             print("client receive data:")
-            data = self.recv()
+            _data = self.socket.recv(1024)
+            if _data.startswith(b'model'):
+                _data = self.recv_param(_data)
+                if _data == b'':
+                    continue
+            data = _data.decode()
             print(data)
 
             if data == "start train":
-                diff = self.client.local_train(self.client.local_model)
+                diff = self.client.local_train(self.global_model)
                 self.send("start")
                 for name in diff:
                     np_params = diff[name].detach().numpy()
@@ -72,7 +93,7 @@ if __name__ == '__main__':
 
     with open("../utils/conf.json", 'r') as f:
         conf = json.load(f)
-    train_datasets, _ = datasets.get_dataset("../data/", conf["type"])
+    train_datasets, _ = datasets.get_dataset("../data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     client0 = Client(conf, models.get_model(conf["model_name"]), train_datasets, args.id)
 
     client_socket = ClientSocket("127.0.0.1", 8888, client0)
@@ -1,24 +1,23 @@
 import json
 import socket
+import struct
 import threading
-import time
 
 import numpy as np
 import torch
 
 import datasets
+from broadcast import ModelBroadcaster
 from server import Server
 
-global weight_accumulator
-# 记录已经收到的客户端模型数量
-global reach_clients
-# 一轮聚合完成？
-global is_agg_ok
+# 流式聚合器：每收到一层就累加，本轮所有客户端上传完成时唤醒聚合线程
+global aggregator
 # 联邦学习结束？
 global agg_over
-weight_accumulator = {}
-reach_clients = 0
-is_agg_ok = False
+# 全局模型的增量下发
+global broadcaster
+aggregator = None
+broadcaster = None
 agg_over = False
 
 
@@ -27,13 +26,14 @@ class Agg(threading.Thread):
         super(Agg, self).__init__()
         self.current_epoch = 0
         self.server = _server
-        self.n_clients = self.server.conf["k"]
 
     def agg(self):
-        global weight_accumulator
         global agg_over
         if self.current_epoch < self.server.conf["global_epochs"]:
-            self.server.model_aggregate(weight_accumulator)
+            # 聚合和提交期间不下发模型
+            with self.server.model_store.lock:
+                self.server.model_aggregate(aggregator)
+                self.server.model_store.commit()
             acc, loss = self.server.model_eval()
             print("Global Epoch {}, acc: {}, loss: {}\n".format(self.current_epoch, acc, loss))
             self.current_epoch += 1
@@ -44,15 +44,12 @@ class Agg(threading.Thread):
             print("federated learning over ... ")
 
     def run(self):
-        global is_agg_ok
-        global reach_clients
-        while (1):
-            if reach_clients == self.n_clients:
-                self.agg()
-                # 下一轮训练
-                reach_clients = 0
-                # 聚合完成
-                is_agg_ok = True
+        while not agg_over:
+            # 最后一个客户端上传完成时被唤醒，此时聚合结果已经累加完毕
+            aggregator.wait()
+            self.agg()
+            # 清零开始下一轮，同时唤醒等待本轮结果的接收线程
+            aggregator.reset()
 
 
 class ClientRecv(threading.Thread):
@@ -60,6 +57,8 @@ class ClientRecv(threading.Thread):
         super(ClientRecv, self).__init__()
         self.client_socket = _client_socket
         self.server = _server
+        # 客户端当前持有的全局模型版本，-1表示还没有下发过
+        self.client_version = -1
         self.TYPE_MAP = {
             "float32": np.float32,
             "float64": np.float64,
@@ -76,25 +75,19 @@ class ClientRecv(threading.Thread):
         data = _data.decode()
         return data
 
+    # 下发全局模型：b'model' + 8字节长度 + 相对客户端持有版本的压缩增量
     def send_param_to_client(self):
-        # for name, data in self.server.global_model.state_dict().items():
-        #     self.send(str(name) + ':' + str(data))
-        pass
+        self.client_version, message = broadcaster.message(self.client_version)
+        self.client_socket.sendall(b'model' + struct.pack('>Q', len(message)) + message)
 
     def run(self):
-        global weight_accumulator
-        global reach_clients
-        global is_agg_ok
-        global agg_over
         signal = -1
         name = ""
         type = ""
         shape = (0,)
         params = b''
 
-        for _name, _params in self.server.global_model.state_dict().items():
-            weight_accumulator[_name] = torch.zeros_like(_params)
-
+        self.send_param_to_client()
         self.send("start train")
 
         while (1):
@@ -129,7 +122,7 @@ class ClientRecv(threading.Thread):
             else:
                 np_param = np.frombuffer(params, dtype=self.TYPE_MAP[type]).reshape(shape)
                 t_param = torch.tensor(np_param)
-                weight_accumulator[name].add_(t_param)
+                aggregator.add_layer(name, t_param)
                 data = _data.decode()
                 signal = -1
 
@@ -137,17 +130,11 @@ class ClientRecv(threading.Thread):
                 pass
             elif data == "end":
                 print(data)
-                reach_clients += 1
-                print(reach_clients)
-                while (1):
-                    if is_agg_ok:
-                        # self.send_param_to_client()
-                        for _name, _params in self.server.global_model.state_dict().items():
-                            weight_accumulator[_name] = torch.zeros_like(_params)
-                        break
-                    time.sleep(0.1)
-
-                is_agg_ok = False
+                # 本轮最后一个客户端到达时聚合线程被唤醒，这里等待本轮聚合完成
+                round_id = aggregator.finish_client()
+                print(aggregator.count)
+                aggregator.wait_round(round_id)
+
                 if agg_over:  # 联邦学习结束
                     self.send("agg over")
                     break
@@ -219,7 +206,11 @@ class ServerSocket:
 if __name__ == '__main__':
     with open("../utils/conf.json", 'r') as f:
         conf = json.load(f)
-    _, eval_datasets = datasets.get_dataset("../data/", conf["type"])
+    _, eval_datasets = datasets.get_dataset("../data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     server = Server(conf, eval_datasets)
+    # 客户端直接上传浮点更新，不加掩码，只支持浮点聚合
+    server.require_float_mode()
+    aggregator = server.new_aggregator(conf["k"])
 
+    broadcaster = ModelBroadcaster(server.new_model_store())
     server_socket = ServerSocket("127.0.0.1", 8888, server)
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+# 扁平向量的存储：mmap_dir为空时放在内存中；否则放在mmap_dir下的内存映射文件里，
+# 由操作系统按页换入换出，模型大小可以超过内存（只支持CPU）
+def flat_tensor(numel, dtype=torch.float32, device=torch.device("cpu"), mmap_dir="", name="flat"):
+    if not mmap_dir or torch.device(device).type != "cpu":
+        return torch.zeros(numel, dtype=dtype, device=device)
+    numpy_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+    os.makedirs(mmap_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=name + "-", suffix=".bin", dir=mmap_dir)
+    os.close(fd)
+    # 新建的映射文件内容全为0
+    array = np.memmap(path, dtype=numpy_dtype, mode="w+", shape=(max(numel, 1),))[:numel]
+    # 映射建立后即可删除文件名，进程退出时文件自动回收
+    os.remove(path)
+    return torch.from_numpy(array)
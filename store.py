@@ -0,0 +1,142 @@
+import threading
+from collections import deque
+
+import torch
+
+from broadcast import decode_bits, encode_bits, resolve_codec
+from prg import chunk_ranges
+from storage import flat_tensor
+
+
+# 全局模型的版本库：只保存当前版本的一份快照，以及最近若干个版本之间的差值（按位异或后分块做字节平面编码），
+# 差值放在环形缓冲区中，超过store_versions个或总字节数超过store_bytes（为0时不限）时淘汰最旧的；
+# 可以还原任意保留的版本，"某版本以来的变化"每个版本只计算一次，之后直接复用
+# store_versions为0时不保存快照和差值，提交只增加版本号，下发时总是读取当前模型的完整快照
+# 所有计算都按mask_chunk分块进行，快照放在mmap_dir中，不产生整个模型大小的临时张量
+class ModelStore(object):
+    def __init__(self, layout, flat, model, conf):
+        self.layout = layout
+        # 全局模型绑定的扁平向量（按int32解释）
+        self.bits = flat.view(torch.int32)
+        self.model = model
+        self.codec = resolve_codec(conf["broadcast_codec"])
+        self.max_versions = conf["store_versions"]
+        self.max_bytes = conf["store_bytes"]
+        self.chunk_size = conf["mask_chunk"]
+        self.version = 0
+        # 当前版本的快照，聚合过程中模型被修改时仍然可以读到完整的已提交版本
+        self.snapshot = None
+        if self.max_versions > 0:
+            self.snapshot = flat_tensor(layout.numel, torch.int32, layout.device, conf["mmap_dir"], "model_snapshot")
+            for start, end in self.chunks():
+                self.snapshot[start:end].copy_(self.bits[start:end])
+        self.others = self.read_others()
+        # [(版本号v, 版本v-1到v的各块压缩差值, 版本v-1的整数缓冲区)]，按版本从旧到新
+        self.diffs = deque()
+        self.bytes = 0
+        # 当前版本下，基准版本 -> 各块压缩后的变化量
+        self.changes = {}
+        # 修改全局模型（聚合并提交）和读取已提交版本时都持有这个锁
+        self.lock = threading.RLock()
+
+    def chunks(self):
+        return chunk_ranges(self.layout.numel, self.chunk_size)
+
+    # 不在扁平布局中的整数缓冲区（如num_batches_tracked），很小，直接保存
+    def read_others(self):
+        others = {}
+        for name, data in self.model.state_dict().items():
+            if name not in self.layout.names:
+                others[name] = data.clone()
+        return others
+
+    # 最旧的保留版本
+    def oldest(self):
+        return self.version - len(self.diffs)
+
+    # 一轮聚合完成后提交新版本，返回新的版本号
+    def commit(self):
+        with self.lock:
+            others = self.read_others()
+            self.version += 1
+            self.changes = {}
+            if self.snapshot is None:
+                self.others = others
+                return self.version
+            diff = []
+            for start, end in self.chunks():
+                bits = self.bits[start:end]
+                snapshot = self.snapshot[start:end]
+                diff.append(encode_bits(torch.bitwise_xor(bits, snapshot), self.codec))
+                snapshot.copy_(bits)
+            self.diffs.append((self.version, diff, self.others))
+            self.bytes += sum(len(chunk) for chunk in diff)
+            self.others = others
+            while self.diffs and (len(self.diffs) > self.max_versions or
+                                  (self.max_bytes and self.bytes > self.max_bytes)):
+                self.bytes -= sum(len(chunk) for chunk in self.diffs.popleft()[1])
+            return self.version
+
+    # 当前已提交版本的各块（int32），版本库关闭时直接读取全局模型（调用方持有锁）
+    def current_chunks(self):
+        bits = self.bits if self.snapshot is None else self.snapshot
+        for start, end in self.chunks():
+            yield bits[start:end]
+
+    # 版本base到当前版本的变化（按位异或后分块做字节平面编码），base没有保留时返回None
+    def changes_since(self, base):
+        with self.lock:
+            if base < self.oldest() or base > self.version:
+                return None
+            if base not in self.changes:
+                newer = [diff for version, diff, others in self.diffs if version > base]
+                if len(newer) == 1:
+                    # 只差一个版本时直接复用提交时压缩好的差值
+                    self.changes[base] = newer[0]
+                else:
+                    self.changes[base] = [encode_bits(changes, self.codec)
+                                          for changes in self._xor_chunks(newer)]
+            return self.changes[base]
+
+    # 多个版本差值逐块异或
+    def _xor_chunks(self, diffs):
+        for i, (start, end) in enumerate(self.chunks()):
+            changes = torch.zeros(end - start, dtype=torch.int32)
+            for diff in diffs:
+                changes.bitwise_xor_(decode_bits(diff[i], self.codec))
+            yield changes
+
+    # 把保留的版本逐块写进out（int32视图），返回该版本的整数缓冲区，版本没有保留时返回None
+    def _restore(self, version, out):
+        with self.lock:
+            if version == self.version:
+                for (start, end), bits in zip(self.chunks(), self.current_chunks()):
+                    out[start:end].copy_(bits)
+                return self.others
+            if self.snapshot is None or version < self.oldest() or version > self.version:
+                return None
+            newer = [diff for v, diff, others in self.diffs if v > version]
+            for (start, end), changes in zip(self.chunks(), self._xor_chunks(newer)):
+                torch.bitwise_xor(self.snapshot[start:end], changes, out=out[start:end])
+            for v, diff, old_others in self.diffs:
+                if v == version + 1:
+                    return old_others
+
+    # 还原保留的版本：返回(扁平参数向量, 整数缓冲区)，版本没有保留时返回None
+    def materialize(self, version):
+        flat = self.layout.empty()
+        others = self._restore(version, flat.view(torch.int32))
+        if others is None:
+            return None
+        return flat, others
+
+    # 把全局模型回滚到保留的版本（逐块原地写回），回滚本身作为一个新版本提交
+    def rollback(self, version):
+        with self.lock:
+            others = self._restore(version, self.bits)
+            if others is None:
+                return None
+            state_dict = self.model.state_dict()
+            for name, data in others.items():
+                state_dict[name].copy_(data)
+            return self.commit()
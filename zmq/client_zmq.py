@@ -1,4 +1,5 @@
 import argparse
+import copy
 import json
 import threading
 
@@ -6,6 +7,7 @@ import zmq
 
 import datasets
 import models
+from broadcast import ModelReceiver
 from client import Client
 
 
@@ -15,6 +17,9 @@ class ClientZMQ(threading.Thread):
         self.ip = _ip
         self.port = _port
         self.client = _client
+        # 服务器下发的全局模型（完整快照或增量）保存在单独的副本中，本地训练从它开始并与它求差值
+        self.global_model = copy.deepcopy(self.client.local_model)
+        self.receiver = ModelReceiver(self.global_model)
         self.init()
 
     def init(self):
@@ -37,10 +42,13 @@ class ClientZMQ(threading.Thread):
         self.send("connect")
         while True:
             # print("client receive data:")
-            data = self.socket.recv()
+            frames = self.socket.recv_multipart()
+            data = frames[0]
 
             if data == b'start train':
-                diff = self.client.local_train(self.client.local_model)
+                if len(frames) > 1:
+                    self.receiver.apply(frames[1])
+                diff = self.client.local_train(self.global_model)
                 self.send("start")
                 _ = self.socket.recv()
                 for name in diff:
@@ -79,7 +87,7 @@ if __name__ == '__main__':
 
     with open("../utils/conf.json", 'r') as f:
         conf = json.load(f)
-    train_datasets, _ = datasets.get_dataset("../data/", conf["type"])
+    train_datasets, _ = datasets.get_dataset("../data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     client0 = Client(conf, models.get_model(conf["model_name"]), train_datasets, 2)
     client1 = Client(conf, models.get_model(conf["model_name"]), train_datasets, 6)
 
@@ -1,25 +1,26 @@
 import json
 import threading
-import time
 
 import numpy as np
 import torch
 import zmq
 
 import datasets
+from broadcast import ModelBroadcaster
 from server import Server
 
-global weight_accumulator
-# 记录已经收到的客户端模型数量
-global reach_clients
-# 一轮聚合完成？
-global is_agg_ok
+# 流式聚合器：每收到一层就累加，本轮所有客户端上传完成时唤醒聚合线程
+global aggregator
 # 联邦学习结束？
 global agg_over
-weight_accumulator = {}
-reach_clients = 0
-is_agg_ok = False
+# 全局模型的版本号，每聚合一次加1；异步模式下用来计算更新的陈旧度
+global model_version
+# 全局模型的增量下发
+global broadcaster
+aggregator = None
+broadcaster = None
 agg_over = False
+model_version = 0
 
 
 class Agg(threading.Thread):
@@ -27,14 +28,19 @@ class Agg(threading.Thread):
         super(Agg, self).__init__()
         self.current_epoch = 0
         self.server = _server
-        self.n_clients = self.server.conf["k"]
 
     def agg(self):
-        global weight_accumulator
         global agg_over
+        global model_version
         # print(weight_accumulator)
         if self.current_epoch < self.server.conf["global_epochs"]:
-            self.server.model_aggregate(weight_accumulator)
+            # 聚合期间到达的更新等待本次聚合完成后再累加
+            with aggregator.cond, self.server.model_store.lock:
+                self.server.model_aggregate(aggregator)
+                model_version = self.server.model_store.commit()
+                if self.server.conf["async_buffer"] > 0:
+                    # 异步模式：缓冲区立即清空，开始接收下一批更新，不等模型评估
+                    aggregator.reset()
             # for name, params in self.server.global_model.state_dict().items():
             #     print(name)
             #     print(params)
@@ -48,16 +54,13 @@ class Agg(threading.Thread):
             print("federated learning over ... ")
 
     def run(self):
-        global is_agg_ok
-        global reach_clients
-        while True:
-            if reach_clients == self.n_clients:
-                self.agg()
-                # 下一轮训练
-                reach_clients = 0
-                # 聚合完成
-                is_agg_ok = True
-            time.sleep(1)
+        while not agg_over:
+            # 同步模式下最后一个客户端上传完成时被唤醒，异步模式下缓冲区攒够async_buffer个更新时被唤醒
+            aggregator.wait()
+            self.agg()
+            if self.server.conf["async_buffer"] == 0:
+                # 清零开始下一轮，同时唤醒等待本轮结果的接收线程
+                aggregator.reset()
 
 
 class ClientZMQ(threading.Thread):
@@ -68,6 +71,11 @@ class ClientZMQ(threading.Thread):
         self.ip = _ip
         self.port = _port
         self.server = _server
+        # 客户端当前持有的全局模型版本，-1表示还没有下发过
+        self.client_version = -1
+        # 异步模式下客户端开始训练时的模型版本，以及正在接收的这个更新
+        self.version = 0
+        self.update = {}
         self.TYPE_MAP = {
             "float32": np.float32,
             "float64": np.float64,
@@ -91,49 +99,46 @@ class ClientZMQ(threading.Thread):
         data = _data.decode()
         return data
 
+    # 下发全局模型（相对客户端持有版本的压缩增量），与开始训练的指令放在同一条多帧消息中
     def send_param_to_client(self):
-        # for name, data in self.server.global_model.state_dict().items():
-        #     self.send(str(name) + ':' + str(data))
-        pass
+        self.client_version, message = broadcaster.message(self.client_version)
+        self.socket.send_multipart([b"start train", message])
 
     def run(self):
-        global weight_accumulator
-        global reach_clients
-        global is_agg_ok
-        global agg_over
-
-        for _name, _params in self.server.global_model.state_dict().items():
-            weight_accumulator[_name] = torch.zeros_like(_params)
-
         while True:
             # print("server receive data:")
             _data = self.socket.recv()
             if _data == b'connect':
-                self.send("start train")
+                self.send_param_to_client()
+                self.version = self.client_version
             elif _data == b'start':
                 self.send("")
             elif _data == b'end':
-                reach_clients += 1
-                print(reach_clients)
-                while True:
-                    if is_agg_ok:
-                        # self.send_param_to_client()
-                        for _name, _params in self.server.global_model.state_dict().items():
-                            weight_accumulator[_name] = torch.zeros_like(_params)
-                        break
-
-                    time.sleep(0.1)
-
-                is_agg_ok = False
+                if self.server.conf["async_buffer"] > 0:
+                    # 异步模式：按陈旧度加权后整体放进缓冲区，不等待其他客户端，立即开始下一次训练
+                    # 聚合线程在aggregator.cond下修改model_version，这里持有同一个锁读取并累加，
+                    # 陈旧度对应的正是这个更新被累加进的那一批
+                    with aggregator.cond:
+                        staleness = model_version - self.version
+                        aggregator.add(self.update, (1 + staleness) ** -self.server.conf["staleness_exponent"])
+                        count = aggregator.count
+                    self.update = {}
+                    print("staleness", staleness, count)
+                else:
+                    # 本轮最后一个客户端到达时聚合线程被唤醒，这里等待本轮聚合完成
+                    round_id = aggregator.finish_client()
+                    print(aggregator.count)
+                    aggregator.wait_round(round_id)
+
                 if agg_over:  # 联邦学习结束
                     self.send("agg over")
                     break
                 else:
                     # 一轮聚合结束，重新下发模型梯度
                     self.send_param_to_client()
-                    self.send("start train")
+                    self.version = self.client_version
             else:
-                bytes_msg = _data.split(b'+')
+                bytes_msg = _data.split(b'+', 3)
                 name = bytes_msg[0].decode()
                 _type = bytes_msg[1].decode()
                 dim = bytes_msg[2].decode()
@@ -147,7 +152,11 @@ class ClientZMQ(threading.Thread):
                 np_param = np.frombuffer(bytes_msg[3], dtype=self.TYPE_MAP[_type]).reshape(shape)
                 t_param = torch.tensor(np_param)
                 # print(t_param)
-                weight_accumulator[name].add_(t_param)
+                if self.server.conf["async_buffer"] > 0:
+                    # 异步模式下一个更新的所有层到齐后才能确定属于哪一批，先暂存
+                    self.update[name] = t_param
+                else:
+                    aggregator.add_layer(name, t_param)
                 self.send("")
 
         self.close()
@@ -159,8 +168,13 @@ class ClientZMQ(threading.Thread):
 if __name__ == '__main__':
     with open("../utils/conf.json", 'r') as f:
         conf = json.load(f)
-    _, eval_datasets = datasets.get_dataset("../data/", conf["type"])
+    _, eval_datasets = datasets.get_dataset("../data/", conf["type"], conf["preload_dataset"], conf["dataset_cache"])
     server = Server(conf, eval_datasets)
+    # 客户端直接上传浮点更新，不加掩码，只支持浮点聚合
+    server.require_float_mode()
+    # 异步模式下每攒够async_buffer个更新就聚合一次
+    aggregator = server.new_aggregator(conf["async_buffer"] or conf["k"])
+    broadcaster = ModelBroadcaster(server.new_model_store())
 
     server_zmq0 = ClientZMQ("127.0.0.1", 8080, server)
     server_zmq0.start()